@@ -0,0 +1,58 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+# share of the training tokens covered by the head cluster and by the head
+# plus the first tail cluster; the remaining tokens form the last cluster
+COVERAGE = (0.9, 0.98)
+
+
+def frequency_cutoffs(counts, coverage=COVERAGE):
+    """
+    Cluster boundaries, in frequency rank, for ``AdaptiveLogSoftmaxWithLoss``:
+    the fewest most frequent tokens covering each ``coverage`` share of the
+    histogram ``counts``.
+    """
+    sorted_counts = np.sort(np.asarray(counts))[::-1]
+    covered = np.cumsum(sorted_counts) / max(sorted_counts.sum(), 1)
+    cutoffs = []
+    for share in coverage:
+        cutoff = min(int(np.searchsorted(covered, share)) + 1, len(counts) - 1)
+        if not cutoffs or cutoff > cutoffs[-1]:
+            cutoffs.append(cutoff)
+    return cutoffs
+
+
+class AdaptiveSoftmaxHead(nn.Module):
+    """
+    Adaptive softmax output layer (Grave et al., 2017). Token ids are
+    ranked by their training frequency ``counts``. The frequent head gets a
+    full-width projection, and rarer clusters get projections narrowed by
+    ``div_value`` per cluster, which are only evaluated for the positions
+    whose target falls in them.
+
+    ``loss`` is the exact mean negative log-likelihood of the targets, so
+    perplexities compare directly with the dense head. Calling the module
+    gives exact log-probabilities over the whole vocabulary in token id
+    order. Those serve as logits wherever the dense head's output is used,
+    e.g. for argmax and sampling in generate.py.
+    """
+
+    def __init__(self, d_model, counts, coverage=COVERAGE, div_value=4.):
+        super().__init__()
+        counts = np.asarray(counts)
+        order = np.argsort(-counts, kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        self.register_buffer('rank', torch.from_numpy(rank).long())
+        self.cutoffs = frequency_cutoffs(counts, coverage)
+        self.asm = nn.AdaptiveLogSoftmaxWithLoss(d_model, len(counts), self.cutoffs, div_value=div_value, head_bias=True)
+
+    def forward(self, h):
+        log_probs = self.asm.log_prob(h.reshape(-1, h.size(-1)))
+        return log_probs[:, self.rank].view(*h.shape[:-1], -1)
+
+    def loss(self, h, targets, ignore_index=-100):
+        h, targets = h.reshape(-1, h.size(-1)), targets.reshape(-1)
+        valid = targets != ignore_index
+        return self.asm(h[valid], self.rank[targets[valid]]).loss
@@ -0,0 +1,760 @@
+import argparse
+import os
+import time
+
+import corpus
+from local_tokenizer import TOKENIZER_DIR, load_tokenizer
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def report(label, rate, unit='lines/sec'):
+    print("%-20s %12.0f %s" % (label, rate, unit))
+
+
+def _run_isolated(conn, setup, args, repeat):
+    import resource
+
+    fn = setup(*args)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    conn.send((min(times), peak * 1024))
+
+
+def measure(setup, *args, repeat=3):
+    """
+    Best-of-``repeat`` time and peak extra memory (bytes) of the thunk
+    returned by ``setup(*args)``. On CUDA the allocator's peak is used; on
+    CPU each measurement runs in a forked child so that the growth of its
+    max RSS over the post-setup baseline is the peak of the thunk alone.
+    """
+    import torch
+
+    if torch.cuda.is_available():
+        fn = setup(*args)
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.memory_allocated()
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            torch.cuda.synchronize()
+            times.append(time.perf_counter() - start)
+        return min(times), torch.cuda.max_memory_allocated() - baseline
+
+    import multiprocessing as mp
+
+    ctx = mp.get_context('fork')
+    parent, child = ctx.Pipe()
+    proc = ctx.Process(target=_run_isolated, args=(child, setup, args, repeat))
+    proc.start()
+    result = parent.recv()
+    proc.join()
+    return result
+
+
+def bench_tokenize(opt):
+    from starter import read_corpus
+
+    tokenizer = load_tokenizer(opt.tokenizer)
+    n_lines = len(corpus.read_lines(opt.file))
+    print("%s: %d lines" % (opt.file, n_lines))
+
+    ref, t = timed(read_corpus, opt.file, tokenizer)
+    report('per-line loop', n_lines / t)
+
+    seq, t = timed(corpus.tokenize_file, opt.file, tokenizer, workers=1, batch_size=opt.batch)
+    assert seq.tolist() == ref
+    report('batched, 1 proc', n_lines / t)
+
+    workers = opt.workers or os.cpu_count() or 1
+    seq, t = timed(corpus.tokenize_file, opt.file, tokenizer, workers=workers, batch_size=opt.batch)
+    assert seq.tolist() == ref
+    report('batched, %d procs' % workers, n_lines / t)
+
+    memo = corpus.LineMemoTokenizer(tokenizer)
+    seq, t = timed(corpus.tokenize_file, opt.file, memo, workers=1, batch_size=opt.batch)
+    assert seq.tolist() == ref
+    report('batched + line memo', n_lines / t)
+    print(memo.stats())
+
+
+def bench_loader(opt):
+    from torch.utils.data import DataLoader
+    from data import ShardedTextDataset
+
+    dataset = ShardedTextDataset(opt.store, opt.seqlen)
+    print("%s: %d windows of %d tokens" % (opt.store, len(dataset), opt.seqlen))
+    for workers in opt.workers:
+        loader = DataLoader(dataset, batch_size=opt.batchsize, shuffle=True, drop_last=True,
+                            num_workers=workers, persistent_workers=workers > 0)
+        n_tokens = 0
+        start = time.perf_counter()
+        for epoch in range(opt.epochs):
+            for batch in loader:
+                n_tokens += batch.numel()
+        report('%d workers' % workers, n_tokens / (time.perf_counter() - start), 'tokens/sec')
+
+
+# run in a fresh interpreter so import and load costs are not already paid
+STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import numpy as np
+import torch
+%s
+from corpus import iter_line_batches, iter_lines, tokenize_lines
+seqlen, batchsize = 512, 7
+ids = np.zeros(0, dtype=np.uint16)
+for lines in iter_line_batches(iter_lines(sys.argv[1]), 64):
+    ids = np.concatenate([ids, tokenize_lines(lines, tokenizer)])
+    if len(ids) >= seqlen * batchsize:
+        break
+batch = torch.from_numpy(ids[:seqlen * batchsize].astype(np.int64)).view(batchsize, seqlen)
+print(time.perf_counter() - start)
+"""
+
+
+def bench_startup(opt):
+    import subprocess
+    import sys
+
+    loaders = [
+        ('from_pretrained(%r)' % opt.hub_name,
+         "from transformers import GPT2TokenizerFast\ntokenizer = GPT2TokenizerFast.from_pretrained(%r)" % opt.hub_name),
+        ('local artifact',
+         "from local_tokenizer import LocalTokenizer\ntokenizer = LocalTokenizer(%r)" % opt.tokenizer),
+    ]
+    for label, load in loaders:
+        times = []
+        for _ in range(opt.repeat):
+            out = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT % load, opt.file],
+                                 capture_output=True, text=True, check=True)
+            times.append(float(out.stdout.split()[-1]))
+        print("%-30s time to first batch %.3fs (best of %d)" % (label, min(times), opt.repeat))
+
+
+def loop_positional_table(max_seq_len, d_model):
+    # the original PositionalEncoder construction, kept as the reference
+    import math
+    import torch
+
+    pe = torch.zeros(max_seq_len, d_model)
+    for pos in range(max_seq_len):
+        for i in range(0, d_model, 2):
+            pe[pos, i] = math.sin(pos / (10000 ** ((2 * i)/d_model)))
+            pe[pos, i + 1] = math.cos(pos / (10000 ** ((2 * (i + 1))/d_model)))
+    return pe.unsqueeze(0)
+
+
+def bench_model_init(opt):
+    import torch
+    import starter
+
+    ref, t_loop = timed(loop_positional_table, 4096, opt.d_model)
+    starter._pe_tables.clear()
+    table, t_vec = timed(starter.positional_table, 4096, opt.d_model)
+    assert torch.equal(table, ref)
+    print("pe table, python loop   %.3fs" % t_loop)
+    print("pe table, vectorized    %.3fs" % t_vec)
+
+    starter._pe_tables.clear()
+    _, t_cold = timed(starter.Transformer, opt.vocab_size, opt.d_model, opt.n_layers, opt.heads, 0.1)
+    _, t_warm = timed(starter.Transformer, opt.vocab_size, opt.d_model, opt.n_layers, opt.heads, 0.1)
+    print("Transformer(), before   %.3fs (cold + python loop table)" % (t_cold + t_loop - t_vec))
+    print("Transformer(), cold     %.3fs" % t_cold)
+    print("Transformer(), cached   %.3fs" % t_warm)
+
+
+def _euclidean_setup(fn_name, bs, heads, L, d_k):
+    import torch
+    import q3
+
+    fn = getattr(q3, fn_name)
+    torch.manual_seed(0)
+    q, k, v = [torch.randn(bs, heads, L, d_k) for _ in range(3)]
+    mask = torch.tril(torch.ones((1, L, L), dtype=torch.bool))
+
+    def run():
+        with torch.no_grad():
+            fn(q, k, v, mask)
+    return run
+
+
+def bench_euclidean(opt):
+    import torch
+    import q3
+
+    # the two must agree before their costs are worth comparing
+    torch.manual_seed(0)
+    q, k, v = [torch.randn(2, 4, 64, 16) for _ in range(3)]
+    mask = torch.tril(torch.ones((1, 64, 64), dtype=torch.bool))
+    ref = q3.euclidean_attention(q, k, v, mask)
+    out = q3.euclidean_attention_expanded(q, k, v, mask)
+    print("max abs difference: %.2e" % (out - ref).abs().max())
+
+    print("%6s %-28s %10s %12s" % ('L', 'function', 'time', 'peak mem'))
+    for L in opt.lengths:
+        for name in ['euclidean_attention', 'euclidean_attention_expanded']:
+            t, peak = measure(_euclidean_setup, name, opt.batchsize, opt.heads, L, opt.d_k)
+            print("%6d %-28s %9.3fs %10.1f MB" % (L, name, t, peak / 2**20))
+
+
+def _train_step_setup(opt, configure):
+    # one forward/backward of the full model on random tokens, after
+    # configure(model) has switched on the variant being measured
+    import torch
+    import torch.nn.functional as F
+    import starter
+
+    torch.manual_seed(0)
+    model = starter.Transformer(opt.vocab_size, opt.d_model, opt.n_layers, opt.heads, 0.1)
+    configure(model)
+    model.train()
+    batch = torch.randint(opt.vocab_size, (opt.batchsize, opt.seqlen))
+    inputs, targets = batch[:, :-1], batch[:, 1:].contiguous()
+
+    def run():
+        outputs = model(inputs, None)
+        loss = F.cross_entropy(outputs.view(-1, outputs.size(-1)), targets.view(-1))
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+    return run
+
+
+def report_train_step(label, opt, configure):
+    t, peak = measure(_train_step_setup, opt, configure)
+    n_tokens = opt.batchsize * (opt.seqlen - 1)
+    print("%-24s %10.0f tokens/sec %10.1f MB peak" % (label, n_tokens / t, peak / 2**20))
+
+
+def bench_attention(opt):
+    import torch
+    import starter
+
+    # both backends must produce the same outputs in eval mode
+    torch.manual_seed(0)
+    model = starter.Transformer(1000, 64, 2, 4, 0.1).eval()
+    x = torch.randint(1000, (2, 33))
+    with torch.no_grad():
+        ref = model(x, starter.causal_mask(33, x.device))
+        out = starter.set_attention_backend(model, 'sdpa')(x, None)
+    print("max abs difference: %.2e" % (out - ref).abs().max())
+
+    for backend in starter.ATTENTION_BACKENDS:
+        report_train_step(backend, opt, lambda m, b=backend: starter.set_attention_backend(m, b))
+
+
+def _long_attention_setup(name, bs, heads, L, d_k):
+    import math
+    import torch
+    import q3
+    from blocked_attention import blocked_attention
+
+    scale = 1 / math.sqrt(d_k)
+    fns = {
+        'dot, full': lambda q, k, v, mask: q3.attention(q, k, v, d_k, mask),
+        'dot, blocked': lambda q, k, v, mask: blocked_attention(q, k, v, scale, is_causal=True),
+        'euclidean, full': lambda q, k, v, mask: q3.euclidean_attention_expanded(q, k, v, mask),
+        'euclidean, blocked': lambda q, k, v, mask: blocked_attention(q, k, v, 2., key_norm=1., is_causal=True),
+    }
+    fn = fns[name]
+    torch.manual_seed(0)
+    q, k, v = [torch.randn(bs, heads, L, d_k, requires_grad=True) for _ in range(3)]
+    mask = torch.tril(torch.ones((1, L, L), dtype=torch.bool))
+
+    def run():
+        fn(q, k, v, mask).sum().backward()
+    return run
+
+
+def bench_long_attention(opt):
+    names = ['dot, full', 'dot, blocked', 'euclidean, full', 'euclidean, blocked']
+    print("%6s %-20s %10s %12s" % ('L', 'attention', 'fwd+bwd', 'peak mem'))
+    for L in opt.lengths:
+        for name in names:
+            t, peak = measure(_long_attention_setup, name, opt.batchsize, opt.heads, L, opt.d_k, repeat=1)
+            print("%6d %-20s %9.3fs %10.1f MB" % (L, name, t, peak / 2**20))
+
+
+def _qkv_setup(fused, opt):
+    import torch
+    import starter
+
+    torch.manual_seed(0)
+    attn = starter.MultiHeadAttention(opt.heads, opt.d_model, 0.1)
+    if fused:
+        attn.fuse_qkv()
+    x = torch.randn(opt.batchsize, opt.seqlen, opt.d_model, requires_grad=True)
+
+    def run():
+        attn(x, x, x, is_causal=True).sum().backward()
+    return run
+
+
+def bench_qkv(opt):
+    import torch
+    import starter
+
+    # same weights in both layouts must give the same block output
+    torch.manual_seed(0)
+    ref = starter.MultiHeadAttention(opt.heads, opt.d_model, 0.1).eval()
+    fused = starter.MultiHeadAttention(opt.heads, opt.d_model, 0.1).fuse_qkv().eval()
+    fused.load_state_dict(ref.state_dict())
+    x = torch.randn(2, 64, opt.d_model)
+    with torch.no_grad():
+        diff = (fused(x, x, x, is_causal=True) - ref(x, x, x, is_causal=True)).abs().max()
+    print("max abs difference: %.2e" % diff)
+
+    n_tokens = opt.batchsize * opt.seqlen
+    for label, flag in [('q/k/v_linear', False), ('fused qkv_linear', True)]:
+        t, peak = measure(_qkv_setup, flag, opt, repeat=10)
+        print("%-24s %10.0f tokens/sec %10.1f MB peak" % (label, n_tokens / t, peak / 2**20))
+
+
+def naive_generate(model, ids, max_new_tokens):
+    # greedy decoding that re-encodes the whole prefix for every token, the
+    # reference generate() must agree with
+    import torch
+
+    with torch.no_grad():
+        for _ in range(max_new_tokens):
+            next_ids = model(ids, None)[:, -1].argmax(dim=-1, keepdim=True)
+            ids = torch.cat([ids, next_ids], dim=1)
+    return ids
+
+
+def bench_generate(opt):
+    import torch
+    import starter
+    from generate import generate
+
+    torch.manual_seed(0)
+    model = starter.Transformer(opt.vocab_size, opt.d_model, opt.n_layers, opt.heads, 0.1).eval()
+    prompt = torch.randint(opt.vocab_size, (opt.batchsize, opt.prompt_len))
+    n_tokens = opt.batchsize * opt.max_new_tokens
+
+    ref, t_naive = timed(naive_generate, model, prompt, opt.max_new_tokens)
+    ids, t_cached = timed(generate, model, prompt, opt.max_new_tokens, temperature=0)
+    assert torch.equal(ids, ref)
+    report('re-encode prefix', n_tokens / t_naive, 'tokens/sec')
+    report('kv cache', n_tokens / t_cached, 'tokens/sec')
+
+    g = torch.Generator().manual_seed(0)
+    _, t = timed(generate, model, prompt, opt.max_new_tokens, temperature=0.8, top_k=50, top_p=0.9, generator=g)
+    report('kv cache, top-k/top-p', n_tokens / t, 'tokens/sec')
+
+
+async def engine_outputs(model, prompts, new_tokens, slots, slot_len):
+    # greedy completions of all prompts, run through one Engine together
+    import asyncio
+    import serve
+
+    engine = serve.Engine(model, slots, slot_len)
+    runner = asyncio.ensure_future(engine.run())
+    requests = [engine.submit(serve.Request(p, n, temperature=0)) for p, n in zip(prompts, new_tokens)]
+    try:
+        for req in requests:
+            async for _ in req.stream():
+                pass
+    finally:
+        runner.cancel()
+    return [req.generated for req in requests]
+
+
+def bench_serve(opt):
+    import asyncio
+    import torch
+    import starter
+    import serve
+    from generate import generate
+
+    # small random model: the load test only needs the forward pass
+    torch.manual_seed(0)
+    model = starter.Transformer(opt.vocab_size, opt.d_model, opt.n_layers, opt.heads, 0.1).eval()
+
+    # batched slots of different lengths, retired at different steps, must
+    # decode exactly as each prompt does alone
+    prompts = [torch.randint(opt.vocab_size, (n,)).tolist() for n in (3, 10, 1, 25, 7)]
+    new_tokens = [5, 12, 8, 4, 10]
+    outputs = asyncio.run(engine_outputs(model, prompts, new_tokens, 3, opt.slot_len))
+    for prompt, n, out in zip(prompts, new_tokens, outputs):
+        assert out == generate(model, torch.tensor([prompt]), n, temperature=0)[0, len(prompt):].tolist()
+
+    print("%d requests, %.1f/sec arrivals, prompts %d-%d, outputs %d-%d tokens" % (
+        opt.requests, opt.rate, opt.prompt_lens[0], opt.prompt_lens[1], opt.new_tokens[0], opt.new_tokens[1]))
+    print("%6s %10s %10s %10s %10s %12s %7s" % ('slots', 'lat p50', 'lat p99', 'ttft p50', 'ttft p99', 'tokens/sec', 'steps'))
+    for slots in opt.slot_counts:
+        opt.slots = slots
+        stats, steps = asyncio.run(serve.run_load_test(model, opt))
+        print("%6d %9.2fs %9.2fs %9.2fs %9.2fs %12.1f %7d" % (
+            slots, stats['latency_p50'], stats['latency_p99'], stats['ttft_p50'], stats['ttft_p99'],
+            stats['tokens_per_sec'], steps))
+
+
+def truncated_draft(model, n_layers):
+    # the target's own embedding, first layers and head: a draft that needs
+    # no training, for measuring the machinery when no trained pair is given
+    import copy
+
+    draft = copy.deepcopy(model)
+    draft.decoder.layers = draft.decoder.layers[:n_layers]
+    draft.decoder.N = n_layers
+    return draft
+
+
+def bench_speculative(opt):
+    import torch
+    import starter
+    from generate import DraftModel, generate, load_draft_model, load_model, speculative_generate
+
+    opt.device = torch.device('cpu')
+    torch.manual_seed(0)
+    model = load_model(opt)
+    if opt.draft_loadname is not None:
+        draft = load_draft_model(opt)
+    else:
+        draft = truncated_draft(model, opt.draft_n_layers)
+        print("no -draft_loadname, drafting with the target's first %d layers" % opt.draft_n_layers)
+    prompt = torch.randint(opt.vocab_size, (1, opt.prompt_len))
+
+    for label, temperature in [('greedy', 0.), ('sampled', opt.temperature)]:
+        g = torch.Generator().manual_seed(0)
+        _, t_ref = timed(generate, model, prompt, opt.max_new_tokens, temperature, generator=g)
+        report('%s, plain' % label, opt.max_new_tokens / t_ref, 'tokens/sec')
+        for k in opt.k:
+            g = torch.Generator().manual_seed(0)
+            (ids, stats), t = timed(speculative_generate, model, prompt, opt.max_new_tokens, DraftModel(draft), k,
+                                    temperature, generator=g)
+            report('%s, k=%d' % (label, k), opt.max_new_tokens / t, 'tokens/sec')
+            print_speculation(stats, ids.size(1) - opt.prompt_len, t_ref / t)
+
+
+def print_speculation(stats, n_new, speedup):
+    print("    acceptance %.2f, %.2f tokens per target forward, speedup %.2fx" % (
+        stats['accepted'] / max(stats['proposed'], 1), n_new / stats['forwards'], speedup))
+
+
+def bench_prompt_lookup(opt):
+    import numpy as np
+    import torch
+    from generate import PromptLookup, generate, load_model, speculative_generate
+
+    opt.device = torch.device('cpu')
+    torch.manual_seed(0)
+    model = load_model(opt)
+    tokens = corpus.read_corpus_cached(opt.file, load_tokenizer(opt.tokenizer))
+    starts = np.linspace(0, len(tokens) - opt.prompt_len, opt.prompts).astype(np.int64)
+    prompts = [torch.from_numpy(tokens[s:s + opt.prompt_len].astype(np.int64)).unsqueeze(0) for s in starts]
+    n_tokens = opt.prompts * opt.max_new_tokens
+    print("%s: %d prompts of %d tokens, %d new tokens each, greedy" % (
+        opt.file, opt.prompts, opt.prompt_len, opt.max_new_tokens))
+
+    t_ref, refs = 0., []
+    for prompt in prompts:
+        ids, t = timed(generate, model, prompt, opt.max_new_tokens, temperature=0)
+        refs.append(ids)
+        t_ref += t
+    report('plain', n_tokens / t_ref, 'tokens/sec')
+    for ngram in opt.ngram:
+        for k in opt.k:
+            total = {'forwards': 0, 'proposed': 0, 'accepted': 0}
+            t_spec = 0.
+            for prompt, ref in zip(prompts, refs):
+                (ids, stats), t = timed(speculative_generate, model, prompt, opt.max_new_tokens,
+                                        PromptLookup(ngram), k, temperature=0)
+                assert torch.equal(ids, ref)
+                t_spec += t
+                for key in total:
+                    total[key] += stats[key]
+            report('n<=%d, k=%d' % (ngram, k), n_tokens / t_spec, 'tokens/sec')
+            print_speculation(total, n_tokens, t_ref / t_spec)
+
+
+def _adam_step_setup(opt, tied):
+    # forward, backward and Adam update, as in train_model
+    import torch
+    import torch.nn.functional as F
+    import starter
+
+    torch.manual_seed(0)
+    model = starter.Transformer(opt.vocab_size, opt.d_model, opt.n_layers, opt.heads, 0.1, tied=tied)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-5, betas=(0.9, 0.98), eps=1e-9)
+    batch = torch.randint(opt.vocab_size, (opt.batchsize, opt.seqlen))
+    inputs, targets = batch[:, :-1], batch[:, 1:].contiguous()
+
+    def run():
+        outputs = model(inputs, None)
+        loss = F.cross_entropy(outputs.view(-1, outputs.size(-1)), targets.view(-1))
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    return run
+
+
+def bench_tied(opt):
+    import io
+    import torch
+    import starter
+
+    print("%-8s %12s %14s %14s %12s %12s" % ('', 'params', 'checkpoint', 'train peak', 'step', 'tokens/sec'))
+    for tied in (False, True):
+        model = starter.Transformer(opt.vocab_size, opt.d_model, opt.n_layers, opt.heads, 0.1, tied=tied)
+        n_params = sum(p.numel() for p in model.parameters())
+        buf = io.BytesIO()
+        torch.save(model.state_dict(), buf)
+        t, peak = measure(_adam_step_setup, opt, tied)
+        print("%-8s %12d %11.1f MB %11.1f MB %11.3fs %12.0f" % (
+            'tied' if tied else 'untied', n_params, buf.tell() / 2**20, peak / 2**20, t,
+            opt.batchsize * (opt.seqlen - 1) / t))
+
+
+def _loss_step_setup(opt, bs, loss_chunk):
+    # forward and backward through compute_loss, as train_model runs it
+    import argparse
+    import torch
+    import starter
+
+    torch.manual_seed(0)
+    model = starter.Transformer(opt.vocab_size, opt.d_model, opt.n_layers, opt.heads, 0.1, tied=True)
+    batch = torch.randint(opt.vocab_size, (bs, opt.seqlen))
+    inputs, targets = batch[:, :-1], batch[:, 1:].contiguous()
+    step_opt = argparse.Namespace(loss_chunk=loss_chunk)
+
+    def run():
+        starter.compute_loss(model, inputs, targets, None, None, step_opt).backward()
+        model.zero_grad(set_to_none=True)
+    return run
+
+
+def bench_loss(opt):
+    import numpy as np
+
+    print("%-14s %6s %12s %12s" % ('loss', 'batch', 'peak', 'tokens/sec'))
+    fits = {}
+    for label, chunk in [('dense', 0), ('chunk=%d' % opt.loss_chunk, opt.loss_chunk)]:
+        peaks = []
+        for bs in opt.batch_sizes:
+            t, peak = measure(_loss_step_setup, opt, bs, chunk, repeat=1)
+            peaks.append(peak / 2**20)
+            print("%-14s %6d %9.1f MB %12.0f" % (label, bs, peaks[-1], bs * (opt.seqlen - 1) / t))
+        # peak grows about linearly in the batch size
+        fits[label] = np.polyfit(opt.batch_sizes, peaks, 1)
+    slope, base = fits['dense']
+    budget = slope * opt.batchsize + base
+    print("budget of dense batch %d: %.0f MB" % (opt.batchsize, budget))
+    for label, (slope, base) in fits.items():
+        print("  %-12s %.1f MB per sequence, fits batch %d" % (label, slope, int((budget - base) // slope)))
+
+
+def load_counts(opt):
+    # training histogram from a shard store or a corpus file, else a
+    # Zipf(1) stand-in with the shape of wikitext's
+    import numpy as np
+
+    if opt.store is not None:
+        from shards import token_counts
+        return token_counts(opt.store, opt.vocab_size)
+    if opt.file is not None:
+        tokens = corpus.read_corpus_cached(opt.file, load_tokenizer(opt.tokenizer), opt.cache_dir)
+        return np.bincount(tokens, minlength=opt.vocab_size)
+    rng = np.random.default_rng(0)
+    return np.round(1e7 / rng.permutation(np.arange(1, opt.vocab_size + 1))).astype(np.int64)
+
+
+def _head_setup(opt, counts, adaptive, train):
+    # a training step (forward, backward, Adam) or an evaluation forward
+    # through compute_loss, on batches drawn from the token histogram
+    import argparse
+    import torch
+    import starter
+
+    torch.manual_seed(0)
+    model = starter.Transformer(opt.vocab_size, opt.d_model, opt.n_layers, opt.heads, 0.1,
+                                tied=not adaptive, counts=counts if adaptive else None)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-5, betas=(0.9, 0.98), eps=1e-9)
+    probs = torch.from_numpy(counts / counts.sum())
+    batch = torch.multinomial(probs, opt.batchsize * opt.seqlen, replacement=True).view(opt.batchsize, opt.seqlen)
+    inputs, targets = batch[:, :-1], batch[:, 1:].contiguous()
+    step_opt = argparse.Namespace(loss_chunk=0)
+
+    def run():
+        if train:
+            loss = starter.compute_loss(model, inputs, targets, None, None, step_opt)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        else:
+            model.eval()
+            with torch.no_grad():
+                starter.compute_loss(model, inputs, targets, None, None, step_opt)
+    return run
+
+
+def bench_adaptive(opt):
+    import torch
+    import torch.nn.functional as F
+    from adaptive_softmax import AdaptiveSoftmaxHead
+
+    counts = load_counts(opt)
+    head = AdaptiveSoftmaxHead(opt.d_model, counts)
+    shares = [counts[head.rank.numpy() < c].sum() / counts.sum() for c in head.cutoffs]
+    print("cutoffs %s, covering %s of the tokens" % (head.cutoffs, ', '.join('%.3f' % s for s in shares)))
+
+    # exactness: log-probs normalize over the vocabulary and the loss is
+    # their mean over the targets
+    h = torch.randn(64, opt.d_model, dtype=torch.float64)
+    targets = torch.multinomial(torch.from_numpy(counts / counts.sum()), 64, replacement=True)
+    head = head.double()
+    with torch.no_grad():
+        log_probs = head(h)
+        print("max |logsumexp|: %.2e, loss vs log-probs: %.2e" % (
+            log_probs.logsumexp(dim=-1).abs().max(),
+            abs(head.loss(h, targets) - F.nll_loss(log_probs, targets))))
+
+    n_tokens = opt.batchsize * (opt.seqlen - 1)
+    print("%-10s %12s %12s %14s %12s" % ('head', 'train peak', 'train', 'eval peak', 'eval'))
+    for adaptive in (False, True):
+        t_train, peak_train = measure(_head_setup, opt, counts, adaptive, True)
+        t_eval, peak_eval = measure(_head_setup, opt, counts, adaptive, False)
+        print("%-10s %9.1f MB %8.0f t/s %11.1f MB %8.0f t/s" % (
+            'adaptive' if adaptive else 'dense', peak_train / 2**20, n_tokens / t_train,
+            peak_eval / 2**20, n_tokens / t_eval))
+
+
+def add_model_args(p):
+    p.add_argument('-d_model', type=int, default=512)
+    p.add_argument('-n_layers', type=int, default=6)
+    p.add_argument('-heads', type=int, default=8)
+    p.add_argument('-vocab_size', type=int, default=50257)
+    p.add_argument('-seqlen', type=int, default=512)
+    p.add_argument('-batchsize', type=int, default=2)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-tokenizer', type=str, default=TOKENIZER_DIR)
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    p = sub.add_parser('tokenize')
+    p.add_argument('-file', type=str, default='wiki2.valid.txt')
+    p.add_argument('-workers', type=int, default=0)
+    p.add_argument('-batch', type=int, default=corpus.LINE_BATCH)
+    p.set_defaults(fn=bench_tokenize)
+
+    p = sub.add_parser('loader')
+    p.add_argument('-store', type=str, required=True)
+    p.add_argument('-seqlen', type=int, default=512)
+    p.add_argument('-batchsize', type=int, default=7)
+    p.add_argument('-epochs', type=int, default=3)
+    p.add_argument('-workers', type=int, nargs='+', default=[0, 1, 2, 4])
+    p.set_defaults(fn=bench_loader)
+
+    p = sub.add_parser('startup')
+    p.add_argument('-file', type=str, default='wiki2.valid.txt')
+    p.add_argument('-hub_name', type=str, default='gpt2')
+    p.add_argument('-repeat', type=int, default=3)
+    p.set_defaults(fn=bench_startup)
+
+    p = sub.add_parser('model_init')
+    add_model_args(p)
+    p.set_defaults(fn=bench_model_init)
+
+    p = sub.add_parser('euclidean')
+    p.add_argument('-lengths', type=int, nargs='+', default=[64, 128, 256, 511])
+    p.add_argument('-batchsize', type=int, default=1)
+    p.add_argument('-heads', type=int, default=8)
+    p.add_argument('-d_k', type=int, default=64)
+    p.set_defaults(fn=bench_euclidean)
+
+    p = sub.add_parser('attention')
+    add_model_args(p)
+    p.set_defaults(fn=bench_attention)
+
+    p = sub.add_parser('long_attention')
+    p.add_argument('-lengths', type=int, nargs='+', default=[512, 1024, 2048, 4096])
+    p.add_argument('-batchsize', type=int, default=1)
+    p.add_argument('-heads', type=int, default=8)
+    p.add_argument('-d_k', type=int, default=64)
+    p.set_defaults(fn=bench_long_attention)
+
+    p = sub.add_parser('qkv')
+    add_model_args(p)
+    p.set_defaults(fn=bench_qkv)
+
+    p = sub.add_parser('generate')
+    add_model_args(p)
+    p.add_argument('-prompt_len', type=int, default=128)
+    p.add_argument('-max_new_tokens', type=int, default=128)
+    p.set_defaults(fn=bench_generate, batchsize=1)
+
+    p = sub.add_parser('serve')
+    add_model_args(p)
+    p.add_argument('-slot_counts', type=int, nargs='+', default=[1, 8])
+    p.add_argument('-slot_len', type=int, default=256)
+    p.add_argument('-requests', type=int, default=32)
+    p.add_argument('-rate', type=float, default=8.)
+    p.add_argument('-prompt_lens', type=int, nargs=2, default=[16, 64])
+    p.add_argument('-new_tokens', type=int, nargs=2, default=[16, 64])
+    p.add_argument('-seed', type=int, default=10)
+    p.set_defaults(fn=bench_serve, d_model=128, n_layers=2, heads=4)
+
+    p = sub.add_parser('speculative')
+    from generate import add_draft_args
+    add_model_args(p)
+    add_draft_args(p)
+    p.add_argument('-loadname', type=str)
+    p.add_argument('-tied', type=int, default=1)
+    p.add_argument('-attention', type=str, default='reference')
+    p.add_argument('-prompt_len', type=int, default=64)
+    p.add_argument('-max_new_tokens', type=int, default=64)
+    p.add_argument('-temperature', type=float, default=1.)
+    p.add_argument('-k', type=int, nargs='+', default=[2, 4, 8])
+    p.set_defaults(fn=bench_speculative)
+
+    p = sub.add_parser('prompt_lookup')
+    add_model_args(p)
+    p.add_argument('-loadname', type=str)
+    p.add_argument('-tied', type=int, default=1)
+    p.add_argument('-attention', type=str, default='reference')
+    p.add_argument('-file', type=str, default='wiki2.test.txt')
+    p.add_argument('-prompts', type=int, default=8)
+    p.add_argument('-prompt_len', type=int, default=256)
+    p.add_argument('-max_new_tokens', type=int, default=64)
+    p.add_argument('-ngram', type=int, nargs='+', default=[1, 3])
+    p.add_argument('-k', type=int, nargs='+', default=[4, 8])
+    p.set_defaults(fn=bench_prompt_lookup)
+
+    p = sub.add_parser('tied')
+    add_model_args(p)
+    p.set_defaults(fn=bench_tied)
+
+    p = sub.add_parser('loss')
+    add_model_args(p)
+    p.add_argument('-loss_chunk', type=int, default=1024)
+    p.add_argument('-batch_sizes', type=int, nargs='+', default=[1, 2, 4])
+    p.set_defaults(fn=bench_loss, batchsize=7)
+
+    p = sub.add_parser('adaptive')
+    add_model_args(p)
+    p.add_argument('-store', type=str, help="shard store whose histogram sets the clusters")
+    p.add_argument('-file', type=str, help="corpus file to take the histogram from instead")
+    p.add_argument('-cache_dir', type=str, default='cache')
+    p.set_defaults(fn=bench_adaptive)
+
+    opt = parser.parse_args()
+    opt.fn(opt)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import torch
+
+# query rows and key columns per tile
+BLOCK_SIZE = 128
+
+
+def _tiles(i0, i1, n_keys, offset, block_size, mask, is_causal, device):
+    """
+    Key tiles ``(j0, j1, keep)`` that query rows ``i0:i1`` attend to.
+    ``keep`` is the boolean mask of the tile, or None when every entry is
+    kept. Tiles that are fully masked out are not yielded at all.
+    """
+    for j0 in range(0, n_keys, block_size):
+        j1 = min(j0 + block_size, n_keys)
+        keep = None
+        if is_causal:
+            # query i sees keys up to i + offset (offset > 0 with cached keys)
+            if j0 > i1 - 1 + offset:
+                break
+            if j1 - 1 > i0 + offset:
+                rows = torch.arange(i0, i1, device=device).unsqueeze(-1) + offset
+                keep = torch.arange(j0, j1, device=device) <= rows
+        if mask is not None:
+            tile = mask[..., i0:i1, j0:j1]
+            if not tile.any():
+                continue
+            keep = tile if keep is None else tile & keep
+        yield j0, j1, keep
+
+
+def _scores(q, k, k_sq, scale, key_norm):
+    scores = scale * torch.matmul(q, k.transpose(-2, -1))
+    if key_norm:
+        scores = scores - key_norm * k_sq.unsqueeze(-2)
+    return scores
+
+
+class BlockedAttention(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, q, k, v, scale, key_norm, mask, is_causal, block_size):
+        n_queries, n_keys = q.size(-2), k.size(-2)
+        offset = n_keys - n_queries
+        k_sq = (k * k).sum(dim=-1) if key_norm else None
+        out = torch.empty(q.shape[:-1] + v.shape[-1:], dtype=q.dtype, device=q.device)
+        lse = torch.empty(q.shape[:-1], dtype=q.dtype, device=q.device)
+
+        for i0 in range(0, n_queries, block_size):
+            i1 = min(i0 + block_size, n_queries)
+            qi = q[..., i0:i1, :]
+            # running max, softmax denominator and weighted sum of values
+            m = torch.full(qi.shape[:-1], float('-inf'), dtype=q.dtype, device=q.device)
+            l = torch.zeros_like(m)
+            acc = torch.zeros(qi.shape[:-1] + v.shape[-1:], dtype=q.dtype, device=q.device)
+            for j0, j1, keep in _tiles(i0, i1, n_keys, offset, block_size, mask, is_causal, q.device):
+                s = _scores(qi, k[..., j0:j1, :], k_sq[..., j0:j1] if key_norm else None, scale, key_norm)
+                if keep is not None:
+                    s = s.masked_fill(~keep, float('-inf'))
+                m_new = torch.maximum(m, s.amax(dim=-1))
+                # rows with nothing kept so far stay at -inf; shift them by 0
+                m_new = m_new.masked_fill(m_new == float('-inf'), 0.)
+                p = torch.exp(s - m_new.unsqueeze(-1))
+                alpha = torch.exp(m - m_new)
+                l = l * alpha + p.sum(dim=-1)
+                acc = acc * alpha.unsqueeze(-1) + torch.matmul(p, v[..., j0:j1, :])
+                m = m_new
+            out[..., i0:i1, :] = acc / l.unsqueeze(-1)
+            lse[..., i0:i1] = m + torch.log(l)
+
+        ctx.save_for_backward(q, k, v, out, lse, mask)
+        ctx.scale, ctx.key_norm = scale, key_norm
+        ctx.is_causal, ctx.block_size = is_causal, block_size
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        q, k, v, out, lse, mask = ctx.saved_tensors
+        scale, key_norm, block_size = ctx.scale, ctx.key_norm, ctx.block_size
+        n_queries, n_keys = q.size(-2), k.size(-2)
+        offset = n_keys - n_queries
+        k_sq = (k * k).sum(dim=-1) if key_norm else None
+        grad_out = grad_out.contiguous()
+        # softmax backward needs sum_j P_ij dP_ij, which is rowsum(dO * O)
+        delta = (grad_out * out).sum(dim=-1)
+        grad_q, grad_k, grad_v = torch.zeros_like(q), torch.zeros_like(k), torch.zeros_like(v)
+
+        for i0 in range(0, n_queries, block_size):
+            i1 = min(i0 + block_size, n_queries)
+            qi, doi = q[..., i0:i1, :], grad_out[..., i0:i1, :]
+            for j0, j1, keep in _tiles(i0, i1, n_keys, offset, block_size, mask, ctx.is_causal, q.device):
+                kj, vj = k[..., j0:j1, :], v[..., j0:j1, :]
+                # recompute the tile's probabilities from the saved log-sum-exp
+                s = _scores(qi, kj, k_sq[..., j0:j1] if key_norm else None, scale, key_norm)
+                p = torch.exp(s - lse[..., i0:i1].unsqueeze(-1))
+                if keep is not None:
+                    p = p.masked_fill(~keep, 0.)
+                grad_v[..., j0:j1, :] += torch.matmul(p.transpose(-2, -1), doi)
+                ds = p * (torch.matmul(doi, vj.transpose(-2, -1)) - delta[..., i0:i1].unsqueeze(-1))
+                grad_q[..., i0:i1, :] += scale * torch.matmul(ds, kj)
+                grad_k[..., j0:j1, :] += scale * torch.matmul(ds.transpose(-2, -1), qi)
+                if key_norm:
+                    grad_k[..., j0:j1, :] -= 2 * key_norm * kj * ds.sum(dim=-2).unsqueeze(-1)
+        return grad_q, grad_k, grad_v, None, None, None, None, None
+
+
+def blocked_attention(q, k, v, scale, key_norm=0., mask=None, is_causal=False, block_size=BLOCK_SIZE):
+    """
+    softmax(scale * q k^T - key_norm * ||k||^2) v, computed one
+    (block_size x block_size) tile at a time with an online softmax.
+
+    Only a running max, denominator and output are kept per query, and the
+    backward pass recomputes each tile from the saved log-sum-exp, so
+    memory grows linearly in the sequence length instead of quadratically.
+    Tiles that are entirely masked (above the diagonal with ``is_causal``,
+    or all False in ``mask``) are skipped in both passes.
+
+    ``scale=1/sqrt(d_k)`` gives the usual dot-product attention and
+    ``scale=2, key_norm=1`` the negative squared euclidean distance, up to
+    the per-query ||q||^2 that softmax cancels. ``mask`` is (bs, sl, sl)
+    with True where attention is allowed, as for ``attention()``; it is
+    combined with ``is_causal`` when both are given. Attention dropout is
+    not applied.
+    """
+    if mask is not None:
+        mask = mask.unsqueeze(1).bool()
+    return BlockedAttention.apply(q, k, v, scale, key_norm, mask, is_causal, block_size)
@@ -0,0 +1,74 @@
+import torch
+import torch.nn.functional as F
+
+# positions projected to the vocabulary at a time
+CHUNK_SIZE = 1024
+
+
+class ChunkedCrossEntropy(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, hidden, weight, bias, targets, chunk_size, ignore_index, grad_enabled):
+        valid = targets != ignore_index
+        safe_targets = targets.masked_fill(~valid, 0)
+        # needs_input_grad ignores grad mode, which forward always runs
+        # without, so the caller's mode comes in as grad_enabled
+        need_grad = grad_enabled and any(ctx.needs_input_grad[:3])
+        # summed in at least float32 even for half precision hidden states
+        loss = torch.zeros((), dtype=torch.promote_types(hidden.dtype, torch.float32), device=hidden.device)
+        if need_grad:
+            grad_hidden = torch.empty_like(hidden)
+            grad_weight = torch.zeros_like(weight)
+            grad_bias = torch.zeros_like(bias) if bias is not None else None
+
+        for start in range(0, hidden.size(0), chunk_size):
+            end = min(start + chunk_size, hidden.size(0))
+            h, t, v = hidden[start:end], safe_targets[start:end], valid[start:end]
+            logits = F.linear(h, weight, bias)
+            # log_softmax/softmax rather than logsumexp and exp(logits - lse):
+            # on CPU exp is far slower for the large negative arguments of
+            # unlikely tokens than the softmax kernels are
+            log_probs = torch.log_softmax(logits, dim=-1)
+            loss -= (log_probs.gather(1, t.unsqueeze(1)).squeeze(1) * v).sum()
+            del log_probs
+            if need_grad:
+                # d(summed loss)/d(logits) = softmax - one_hot(target), zero
+                # for ignored positions, turned into the input gradients
+                # while the chunk is alive
+                grad = torch.softmax(logits, dim=-1)
+                del logits
+                rows = v.nonzero().squeeze(1)
+                grad[rows, t[rows]] -= 1
+                grad[~v] = 0
+                grad_hidden[start:end] = grad @ weight
+                grad_weight.addmm_(grad.t(), h)
+                if grad_bias is not None:
+                    grad_bias += grad.sum(dim=0)
+
+        n_valid = valid.sum()
+        if need_grad:
+            ctx.save_for_backward(grad_hidden, grad_weight, grad_bias, n_valid)
+        return (loss / n_valid).to(hidden.dtype)
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        grad_hidden, grad_weight, grad_bias, n_valid = ctx.saved_tensors
+        scale = grad_loss / n_valid
+        return (grad_hidden * scale, grad_weight * scale,
+                grad_bias * scale if grad_bias is not None else None, None, None, None, None)
+
+
+def chunked_cross_entropy(hidden, weight, bias, targets, chunk_size=CHUNK_SIZE, ignore_index=-100):
+    """
+    ``F.cross_entropy(F.linear(hidden, weight, bias), targets)`` (mean over
+    targets other than ``ignore_index``) for hidden states (n, d_model) and
+    an output projection (vocab, d_model), without the (n, vocab) logits.
+
+    The projection and loss run ``chunk_size`` rows at a time, and the
+    gradients for hidden, weight and bias are formed in the same pass from
+    each chunk's softmax. Backward only rescales them, so at most one
+    (chunk_size, vocab) block of logits is alive at any point. Under
+    ``torch.no_grad()`` only the loss is computed.
+    """
+    return ChunkedCrossEntropy.apply(hidden, weight, bias, targets, chunk_size, ignore_index,
+                                     torch.is_grad_enabled())
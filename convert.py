@@ -0,0 +1,33 @@
+import argparse
+import os
+
+import torch
+
+from starter import tie_checkpoint
+
+
+def convert_tie(opt):
+    state = torch.load(opt.src, map_location='cpu')
+    tied = tie_checkpoint(state, opt.keep)
+    torch.save(tied, opt.dst)
+    print("%s: %.1f MB -> %s: %.1f MB (kept the %s matrix)" % (
+        opt.src, os.path.getsize(opt.src) / 2**20, opt.dst, os.path.getsize(opt.dst) / 2**20, opt.keep))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='convert', required=True)
+
+    # untied Transformer state dict -> one shared embedding/output matrix
+    p = sub.add_parser('tie')
+    p.add_argument('src', type=str)
+    p.add_argument('dst', type=str)
+    p.add_argument('-keep', type=str, default='out', choices=['out', 'embed'])
+    p.set_defaults(fn=convert_tie)
+
+    opt = parser.parse_args()
+    opt.fn(opt)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+import hashlib
+import itertools
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# tokenized corpora are cached here as .npy arrays, one file per
+# (text content, tokenizer) pair
+CACHE_DIR = 'cache'
+
+# lines handed to the fast tokenizer per call
+LINE_BATCH = 4096
+
+# distinct lines remembered by LineMemoTokenizer
+MEMO_SIZE = 1 << 16
+
+DOC_HEADING = re.compile(r'^ = [^=].* = $')
+
+
+def token_dtype(tokenizer):
+    # GPT-2's 50257 ids fit in uint16, which halves the cache vs int32
+    if len(tokenizer) <= np.iinfo(np.uint16).max + 1:
+        return np.uint16
+    return np.uint32
+
+
+def file_digest(filename, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer):
+    # the serialized fast tokenizer covers vocab, merges and normalization,
+    # so any change to it gives a different cache key
+    if isinstance(tokenizer, LineMemoTokenizer):
+        tokenizer = tokenizer.tokenizer
+    h = hashlib.sha1()
+    backend = getattr(tokenizer, 'backend_tokenizer', None)
+    if backend is not None:
+        # independent of the python wrapper, so GPT2TokenizerFast and the
+        # local artifact built from it share cache entries
+        h.update(backend.to_str().encode())
+    else:
+        h.update(type(tokenizer).__name__.encode())
+        for tok, idx in sorted(tokenizer.get_vocab().items(), key=lambda kv: kv[1]):
+            h.update(('%s\t%d\n' % (tok, idx)).encode())
+    return h.hexdigest()
+
+
+class LineMemoTokenizer:
+    """
+    Bounded LRU memo in front of a tokenizer, keyed by line text.
+
+    Scraped text repeats a lot (blank lines, heading markup, boilerplate),
+    so lines already seen are answered from the memo and only the misses of
+    a batch go to the wrapped tokenizer, in one call. ``hits``/``misses``
+    count lookups; everything else is forwarded to the wrapped tokenizer.
+    """
+
+    def __init__(self, tokenizer, maxsize=MEMO_SIZE):
+        self.tokenizer = tokenizer
+        self.maxsize = maxsize
+        self.memo = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.tokenizer)
+
+    def __getattr__(self, name):
+        # only reached for names not set in __init__, e.g. during unpickling
+        if 'tokenizer' not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.tokenizer, name)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    def stats(self):
+        return "line memo: %d hits, %d misses (%.1f%% hit rate), %d entries" % (
+            self.hits, self.misses, 100 * self.hit_rate, len(self.memo))
+
+    def __call__(self, text):
+        lines = [text] if isinstance(text, str) else text
+        ids = [self.memo.get(line) for line in lines]
+        missing = list(dict.fromkeys(line for line, x in zip(lines, ids) if x is None))
+        self.misses += len(missing)
+        self.hits += len(lines) - len(missing)
+        if missing:
+            fresh = dict(zip(missing, self.tokenizer(missing)['input_ids']))
+            ids = [fresh[line] if x is None else x for line, x in zip(lines, ids)]
+            self.memo.update(fresh)
+        for line in lines:
+            self.memo.move_to_end(line)
+        while len(self.memo) > self.maxsize:
+            self.memo.popitem(last=False)
+        return {'input_ids': ids[0] if isinstance(text, str) else ids}
+
+
+def tokenize_lines(lines, tokenizer, batch_size=LINE_BATCH, lengths=None):
+    # the fast tokenizer is much cheaper per line when handed whole batches,
+    # and np.fromiter avoids growing a python list one id at a time.
+    # per-line token counts are appended to ``lengths`` when it is given
+    dtype = token_dtype(tokenizer)
+    parts = []
+    for start in range(0, len(lines), batch_size):
+        ids = tokenizer(lines[start:start + batch_size])['input_ids']
+        if lengths is not None:
+            lengths.extend(len(x) for x in ids)
+        count = sum(len(x) for x in ids)
+        parts.append(np.fromiter(itertools.chain.from_iterable(ids), dtype=dtype, count=count))
+    if not parts:
+        return np.zeros(0, dtype=dtype)
+    return np.concatenate(parts)
+
+
+# each pool worker unpickles the tokenizer once instead of once per shard
+_worker_tokenizer = None
+
+
+def _init_worker(tokenizer):
+    global _worker_tokenizer
+    # the rust side would otherwise spawn its own thread pool in every worker
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+    _worker_tokenizer = tokenizer
+
+
+def _tokenize_shard(lines):
+    lengths = []
+    hits, misses = getattr(_worker_tokenizer, 'hits', 0), getattr(_worker_tokenizer, 'misses', 0)
+    tokens = tokenize_lines(lines, _worker_tokenizer, lengths=lengths)
+    # memo stats live in the worker, so hand back this shard's share
+    hits = getattr(_worker_tokenizer, 'hits', 0) - hits
+    misses = getattr(_worker_tokenizer, 'misses', 0) - misses
+    return tokens, lengths, hits, misses
+
+
+def read_lines(filename):
+    with open(filename, 'rt') as f:
+        return [line.replace('\n', '') for line in f]
+
+
+def iter_lines(filenames):
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    for filename in filenames:
+        with open(filename, 'rt') as f:
+            for line in f:
+                yield line.replace('\n', '')
+
+
+def iter_line_batches(lines, batch_size=LINE_BATCH):
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def tokenize_file(filename, tokenizer, workers=None, batch_size=LINE_BATCH, with_lengths=False):
+    """
+    Tokenize ``filename`` line by line (same ids as ``read_corpus``) by
+    splitting the lines into contiguous shards, tokenizing the shards in a
+    process pool and concatenating them back in file order. With
+    ``with_lengths`` the per-line token counts are returned as well.
+    """
+    lines = read_lines(filename)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    lengths = []
+    if workers <= 1 or len(lines) <= batch_size:
+        tokens = tokenize_lines(lines, tokenizer, batch_size, lengths)
+    else:
+        # a few shards per worker keeps the pool busy when shards are uneven
+        shard_size = max(batch_size, -(-len(lines) // (workers * 4)))
+        shards = [lines[i:i + shard_size] for i in range(0, len(lines), shard_size)]
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(tokenizer,)) as pool:
+            parts = list(pool.map(_tokenize_shard, shards))
+        tokens = np.concatenate([p[0] for p in parts])
+        for p in parts:
+            lengths.extend(p[1])
+        if isinstance(tokenizer, LineMemoTokenizer):
+            tokenizer.hits += sum(p[2] for p in parts)
+            tokenizer.misses += sum(p[3] for p in parts)
+    if with_lengths:
+        return tokens, np.array(lengths, dtype=np.int64)
+    return tokens
+
+
+def is_document_start(line):
+    # wiki2 articles open with a single-level heading like " = Du Fu = ";
+    # section headings (" = = History = = ") stay inside the article
+    return DOC_HEADING.match(line) is not None
+
+
+def document_starts(lines, lengths):
+    """
+    Token offsets at which each document begins, given the lines of a file
+    and their token counts. Offset 0 is always a start so text before the
+    first heading forms its own document.
+    """
+    line_offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+    starts = [line_offsets[i] for i, line in enumerate(lines) if is_document_start(line)]
+    return np.unique(np.array([0] + starts, dtype=np.int64))
+
+
+def cache_path(filename, tokenizer, cache_dir=CACHE_DIR):
+    name = os.path.basename(filename)
+    key = '%s.%s' % (file_digest(filename)[:16], tokenizer_fingerprint(tokenizer)[:16])
+    return os.path.join(cache_dir, '%s.%s.npy' % (name, key))
+
+
+def docs_path(tokens_path):
+    return tokens_path[:-len('.npy')] + '.docs.npy'
+
+
+def save_array(path, arr):
+    # write to a temp file first so an interrupted run never leaves a
+    # truncated array behind under the final name
+    tmp_path = path + '.tmp.%d' % os.getpid()
+    with open(tmp_path, 'wb') as f:
+        np.save(f, arr)
+    os.replace(tmp_path, path)
+
+
+def cache_tokens(filename, tokenizer, cache_dir=CACHE_DIR, workers=None):
+    """
+    Make sure ``filename`` is tokenized into ``cache_dir`` and return the
+    path of the cached .npy array. The document start offsets are cached
+    next to it (see ``docs_path``).
+    """
+    path = cache_path(filename, tokenizer, cache_dir)
+    if os.path.exists(path) and os.path.exists(docs_path(path)):
+        return path
+
+    seq, lengths = tokenize_file(filename, tokenizer, workers, with_lengths=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    # the token file goes last: its presence marks a complete entry
+    save_array(docs_path(path), document_starts(read_lines(filename), lengths))
+    save_array(path, seq)
+    return path
+
+
+def read_document_starts(tokens_path):
+    return np.load(docs_path(tokens_path))
+
+
+def read_corpus_cached(filename, tokenizer, cache_dir=CACHE_DIR, workers=None):
+    """
+    Drop-in replacement for ``read_corpus`` that returns a flat uint16 array
+    of token ids, loading it from ``cache_dir`` when the same file has
+    already been tokenized with the same tokenizer. The cached array is
+    memory-mapped read-only, so a warm load only touches the header.
+    """
+    return np.load(cache_tokens(filename, tokenizer, cache_dir, workers), mmap_mode='r')
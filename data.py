@@ -0,0 +1,434 @@
+import functools
+import itertools
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+import torch
+import torch.nn as nn
+from torch.utils.data import Dataset
+from torch.utils.data import IterableDataset
+from torch.utils.data import Sampler
+from torch.utils.data import get_worker_info
+
+from corpus import LINE_BATCH, iter_line_batches, iter_lines, tokenize_lines
+from shards import Shard, load_manifest
+
+
+def load_tokens(source):
+    # a path is opened as a read-only memmap (np.save'd .npy or raw uint16
+    # .bin); arrays, including memmaps, are used as they are
+    if isinstance(source, str):
+        if source.endswith('.npy'):
+            return np.load(source, mmap_mode='r')
+        return np.memmap(source, dtype=np.uint16, mode='r')
+    return source
+
+
+class MemmapTextDataset(Dataset):
+    """
+    Fixed-length windows over a flat token store, sliced on demand.
+
+    With the default ``stride == seqlen`` the items are the same as
+    ``TextDataset(create_fixed_length_sequences(...))``, but the tokens stay
+    on disk: each item is a view into the memmap, and only that one window
+    is widened to int64. With ``stride=1`` item ``i`` is the window starting
+    at token ``i``, which is what ``RandomWindowSampler`` draws from. When
+    built from a path, workers reopen the file instead of receiving a
+    pickled copy of the tokens.
+    """
+
+    def __init__(self, source, seqlen, stride=None):
+        self.path = source if isinstance(source, str) else None
+        self.tokens = load_tokens(source)
+        self.seqlen = seqlen
+        self.stride = seqlen if stride is None else stride
+
+    def __len__(self):
+        if len(self.tokens) < self.seqlen:
+            return 0
+        return (len(self.tokens) - self.seqlen) // self.stride + 1
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        start = idx * self.stride
+        window = self.tokens[start:start + self.seqlen]
+        return torch.from_numpy(window.astype(np.int64))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.path is not None:
+            state['tokens'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.tokens is None:
+            self.tokens = load_tokens(self.path)
+
+
+class PackedDocumentDataset(MemmapTextDataset):
+    """
+    ``MemmapTextDataset`` windows that also carry document ids.
+
+    The token store is already densely packed (documents back to back, no
+    padding), so each item is ``(window, segments)`` where ``segments[i]``
+    numbers the document token ``i`` belongs to within the window. Feed the
+    segments to ``document_mask``/``document_positions`` so attention and
+    positions restart at every document boundary.
+    """
+
+    def __init__(self, source, doc_starts, seqlen, stride=None):
+        super().__init__(source, seqlen, stride)
+        self.doc_starts = np.asarray(doc_starts, dtype=np.int64)
+
+    def __getitem__(self, idx):
+        window = super().__getitem__(idx)
+        if idx < 0:
+            idx += len(self)
+        start = idx * self.stride
+        doc = np.searchsorted(self.doc_starts, np.arange(start, start + self.seqlen), side='right')
+        return window, torch.from_numpy(doc - doc[0])
+
+
+# padding value for variable-length batches; F.cross_entropy skips these
+# targets by default
+IGNORE_INDEX = -100
+
+
+@functools.lru_cache(maxsize=64)
+def causal_mask(size, device):
+    # (1, size, size) nopeak mask, cached per length so bucketed batches
+    # do not rebuild it every step
+    return torch.tril(torch.ones((1, size, size), dtype=torch.bool, device=device))
+
+
+def document_mask(segments):
+    """
+    Block-diagonal causal mask for a (batch, L) tensor of segment ids: a
+    token may attend to earlier tokens of its own document only. Returns
+    (batch, L, L), laid out like the nopeak mask ``train_model`` builds.
+    """
+    L = segments.size(1)
+    causal = torch.tril(torch.ones((L, L), dtype=torch.bool, device=segments.device))
+    same_doc = segments.unsqueeze(2) == segments.unsqueeze(1)
+    return causal & same_doc
+
+
+def document_positions(segments):
+    # position ids that restart at 0 at the first token of every document
+    L = segments.size(1)
+    idx = torch.arange(L, device=segments.device).expand_as(segments)
+    new_doc = torch.ones_like(segments, dtype=torch.bool)
+    new_doc[:, 1:] = segments[:, 1:] != segments[:, :-1]
+    doc_start = torch.where(new_doc, idx, torch.zeros_like(idx)).cummax(dim=1).values
+    return idx - doc_start
+
+
+class DocumentDataset(Dataset):
+    """
+    Variable-length sequences: every document of a flat token store, cut
+    into pieces of at most ``max_len`` tokens. ``lengths`` holds the length
+    of each piece for ``BucketBatchSampler``.
+    """
+
+    def __init__(self, source, doc_starts, max_len):
+        self.tokens = load_tokens(source)
+        ends = np.append(np.asarray(doc_starts, dtype=np.int64)[1:], len(self.tokens))
+        starts, lengths = [], []
+        for lo, hi in zip(doc_starts, ends):
+            for start in range(int(lo), int(hi), max_len):
+                starts.append(start)
+                lengths.append(min(max_len, int(hi) - start))
+        self.starts = np.array(starts, dtype=np.int64)
+        self.lengths = np.array(lengths, dtype=np.int64)
+        # a piece needs an input and a target token
+        keep = self.lengths >= 2
+        self.starts, self.lengths = self.starts[keep], self.lengths[keep]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, idx):
+        start = self.starts[idx]
+        return torch.from_numpy(self.tokens[start:start + self.lengths[idx]].astype(np.int64))
+
+
+def pad_collate(batch):
+    # right-pad to the longest sequence; the causal mask keeps real tokens
+    # from seeing the padding and IGNORE_INDEX drops it from the loss
+    return nn.utils.rnn.pad_sequence(batch, batch_first=True, padding_value=IGNORE_INDEX)
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Groups sequences of similar length into batches sized by a token
+    budget: lengths are bucketed in steps of ``bucket_width`` and a bucket
+    whose longest sequence is ``L`` gets ``max_tokens // L`` sequences per
+    batch, so every step costs about the same. Batches are reshuffled each
+    epoch, both within and across buckets.
+    """
+
+    def __init__(self, lengths, max_tokens, bucket_width=64, shuffle=True, seed=None):
+        lengths = np.asarray(lengths)
+        bucket_ids = (lengths - 1) // bucket_width
+        self.buckets = []
+        for b in np.unique(bucket_ids):
+            members = np.nonzero(bucket_ids == b)[0]
+            batch_size = max(1, max_tokens // int((b + 1) * bucket_width))
+            self.buckets.append((members, batch_size))
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return sum(-(-len(members) // batch_size) for members, batch_size in self.buckets)
+
+    def __iter__(self):
+        batches = []
+        for members, batch_size in self.buckets:
+            if self.shuffle:
+                members = self.rng.permutation(members)
+            batches.extend(members[i:i + batch_size].tolist() for i in range(0, len(members), batch_size))
+        if self.shuffle:
+            order = self.rng.permutation(len(batches))
+            batches = [batches[i] for i in order]
+        return iter(batches)
+
+
+class ResumableSampler(Sampler):
+    """
+    Shuffles ``n`` indices with a permutation that depends only on
+    ``(seed, epoch)``, so a restarted job regenerates the same order and
+    ``set_epoch(epoch, start)`` resumes at sample ``start`` directly instead
+    of replaying the batches before it.
+    """
+
+    def __init__(self, n, seed=0):
+        self.n = n
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+
+    def __len__(self):
+        return self.n - self.start
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed((self.seed & 0xffffffff) << 32 | (self.epoch & 0xffffffff))
+        perm = torch.randperm(self.n, generator=g)
+        return iter(perm[self.start:].tolist())
+
+
+class RandomWindowSampler(Sampler):
+    """
+    Draws window start offsets uniformly at random from a stride-1
+    ``MemmapTextDataset``, fresh every epoch, instead of reusing the same
+    ``seqlen`` boundaries. ``epoch_tokens`` sets how many tokens make up one
+    epoch (default: the size of the token store), so the number of windows
+    per epoch is ``epoch_tokens // seqlen``.
+    """
+
+    def __init__(self, dataset, epoch_tokens=None, seed=None):
+        self.n_windows = len(dataset)
+        if epoch_tokens is None:
+            epoch_tokens = len(dataset.tokens)
+        self.num_samples = epoch_tokens // dataset.seqlen
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        else:
+            self.generator.seed()
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        offsets = torch.randint(self.n_windows, (self.num_samples,), generator=self.generator)
+        return iter(offsets.tolist())
+
+
+class ShardedTextDataset(Dataset):
+    """
+    Fixed-length windows over a sharded token store (see ``shards.py``).
+
+    Only the manifest is read up front; shards are mmapped lazily by
+    whichever process first touches them, and pickling drops the open maps,
+    so every DataLoader worker opens its own read-only views and no tokens
+    are copied between processes. Windows never straddle two shards.
+    """
+
+    def __init__(self, store_dir, seqlen):
+        manifest = load_manifest(store_dir)
+        self.paths = [os.path.join(store_dir, s['file']) for s in manifest['shards']]
+        self.seqlen = seqlen
+        counts = [s['n_tokens'] // seqlen for s in manifest['shards']]
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self._shards = {}
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def shard(self, i):
+        if i not in self._shards:
+            self._shards[i] = Shard(self.paths[i])
+        return self._shards[i]
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        i = int(np.searchsorted(self.offsets, idx, side='right')) - 1
+        start = (idx - int(self.offsets[i])) * self.seqlen
+        window = self.shard(i).tokens[start:start + self.seqlen]
+        return torch.from_numpy(window.astype(np.int64))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+
+class StreamingTextDataset(IterableDataset):
+    """
+    Tokenizes ``filenames`` on the fly and yields ``seqlen`` blocks as soon
+    as enough tokens are available, so training starts without reading the
+    whole corpus. At most one line batch of tokens plus a partial block is
+    buffered; the final partial block is dropped like
+    ``create_fixed_length_sequences`` does.
+
+    With several DataLoader workers, worker ``i`` handles every
+    ``num_workers``-th line batch, so blocks arrive interleaved rather than
+    in file order.
+    """
+
+    def __init__(self, filenames, tokenizer, seqlen, batch_lines=LINE_BATCH):
+        self.filenames = [filenames] if isinstance(filenames, str) else list(filenames)
+        self.tokenizer = tokenizer
+        self.seqlen = seqlen
+        self.batch_lines = batch_lines
+
+    def token_chunks(self):
+        batches = iter_line_batches(iter_lines(self.filenames), self.batch_lines)
+        info = get_worker_info()
+        if info is not None:
+            batches = itertools.islice(batches, info.id, None, info.num_workers)
+        for batch in batches:
+            yield tokenize_lines(batch, self.tokenizer, self.batch_lines)
+
+    def __iter__(self):
+        leftover = np.zeros(0, dtype=np.int64)
+        for chunk in self.token_chunks():
+            buf = np.concatenate([leftover, chunk.astype(np.int64)])
+            n_blocks = len(buf) // self.seqlen
+            for i in range(n_blocks):
+                yield torch.from_numpy(buf[i * self.seqlen:(i + 1) * self.seqlen])
+            leftover = buf[n_blocks * self.seqlen:]
+
+
+class Prefetcher:
+    """
+    Runs a DataLoader ``depth`` batches ahead in a background thread and
+    hands back batches already on ``device``.
+
+    On CUDA each batch is staged through a small ring of reusable pinned
+    host buffers and copied with ``non_blocking=True``; a buffer is only
+    refilled once the event recorded after its copy has completed. On CPU
+    the batches are passed through as they are. ``stall_time`` is the time
+    the consumer spent waiting for data during the last pass.
+    """
+
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.pin = self.device.type == 'cuda'
+        self.stall_time = 0.
+        self.batches = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def stats(self):
+        return "data stall: %.2fs over %d batches" % (self.stall_time, self.batches)
+
+    def _stage(self, batch, buffers):
+        # copy a (tensor or tuple of tensors) batch into views of flat pinned
+        # buffers. a buffer only grows, to the largest batch it has held, so
+        # variable-length (bucketed) batches reuse it instead of pinning
+        # fresh memory every step
+        tensors = list(batch) if isinstance(batch, (list, tuple)) else [batch]
+        staged = []
+        for i, t in enumerate(tensors):
+            if i == len(buffers) or buffers[i].numel() < t.numel() or buffers[i].dtype != t.dtype:
+                buffers[i:i + 1] = [torch.empty(t.numel(), dtype=t.dtype).pin_memory()]
+            view = buffers[i][:t.numel()].view(t.shape)
+            view.copy_(t)
+            staged.append(view)
+        return staged
+
+    @staticmethod
+    def _wait(op, stop):
+        # block on a queue operation, giving up once the consumer has gone
+        while not stop.is_set():
+            try:
+                return op(timeout=0.1), True
+            except (queue.Empty, queue.Full):
+                pass
+        return None, False
+
+    def _produce(self, ready, free, stop):
+        try:
+            for batch in self.loader:
+                if self.pin:
+                    (buffers, event), ok = self._wait(free.get, stop)
+                    if not ok:
+                        return
+                    if event is not None:
+                        event.synchronize()
+                    batch = (batch, self._stage(batch, buffers), buffers)
+                if not self._put(ready, batch, stop):
+                    return
+            self._put(ready, StopIteration(), stop)
+        except Exception as e:
+            self._put(ready, e, stop)
+
+    def _put(self, ready, item, stop):
+        return self._wait(lambda timeout: ready.put(item, timeout=timeout), stop)[1]
+
+    def __iter__(self):
+        ready = queue.Queue(maxsize=self.depth)
+        free = queue.Queue()
+        for _ in range(self.depth + 1):
+            free.put(([], None))
+        stop = threading.Event()
+        worker = threading.Thread(target=self._produce, args=(ready, free, stop), daemon=True)
+        worker.start()
+        self.stall_time = 0.
+        self.batches = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                item = ready.get()
+                self.stall_time += time.perf_counter() - start
+                if isinstance(item, StopIteration):
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                if self.pin:
+                    batch, staged, buffers = item
+                    moved = [t.to(self.device, non_blocking=True) for t in staged]
+                    event = torch.cuda.Event()
+                    event.record()
+                    free.put((buffers, event))
+                    item = moved if isinstance(batch, (list, tuple)) else moved[0]
+                self.batches += 1
+                yield item
+        finally:
+            stop.set()
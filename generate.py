@@ -0,0 +1,310 @@
+import argparse
+import sys
+
+import torch
+import torch.nn.functional as F
+
+from local_tokenizer import TOKENIZER_DIR, load_tokenizer
+
+
+def sampling_probs(logits, temperature=1., top_k=0, top_p=1.):
+    """
+    Next-token distribution (..., vocab) after temperature, top-k and
+    nucleus (top-p) filtering. ``temperature=0`` is greedy decoding, a
+    one-hot distribution on the argmax.
+    """
+    if temperature == 0:
+        return F.one_hot(logits.argmax(dim=-1), logits.size(-1)).to(logits.dtype)
+    logits = logits / temperature
+    if top_k:
+        kth = torch.topk(logits, min(top_k, logits.size(-1)), dim=-1).values[..., -1:]
+        logits = logits.masked_fill(logits < kth, float('-inf'))
+    if top_p < 1:
+        # keep the smallest prefix of the sorted distribution whose mass
+        # reaches top_p; the most likely token is always kept
+        sorted_logits, order = torch.sort(logits, dim=-1, descending=True)
+        probs = F.softmax(sorted_logits, dim=-1)
+        drop = probs.cumsum(dim=-1) - probs >= top_p
+        logits = logits.masked_fill(drop.scatter(-1, order, drop), float('-inf'))
+    return F.softmax(logits, dim=-1)
+
+
+def sample(probs, generator=None):
+    # one id per row of a (..., vocab) distribution
+    flat = probs.reshape(-1, probs.size(-1))
+    return torch.multinomial(flat, 1, generator=generator).view(probs.shape[:-1])
+
+
+def prefill(model, ids, cache):
+    # run the prompt through the decoder, projecting only its last position
+    # to the vocabulary; every prompt position is needed in the cache but
+    # only the last one's logits
+    h = model.decoder(ids, None, cache=cache)
+    return model.out(h[:, -1])
+
+
+@torch.no_grad()
+def generate(model, prompt, max_new_tokens, temperature=1., top_k=0, top_p=1., eos_id=None, generator=None):
+    """
+    Continue ``prompt`` (bs, sl) by up to ``max_new_tokens`` ids and
+    return the whole sequence, prompt included.
+
+    The prompt is encoded once into per-layer key/value caches and every
+    step after that feeds only the newest token, so each token costs one
+    position's worth of compute instead of a pass over the whole prefix.
+    Rows that have produced ``eos_id`` keep emitting it, and decoding stops
+    early once every row has.
+    """
+    was_training = model.training
+    model.eval()
+    try:
+        cache = model.new_cache(prompt.size(1) + max_new_tokens)
+        logits = prefill(model, prompt, cache)
+        out = [prompt]
+        done = torch.zeros(prompt.size(0), dtype=torch.bool, device=prompt.device)
+        for step in range(max_new_tokens):
+            if temperature == 0:
+                next_ids = logits.argmax(dim=-1)
+            else:
+                next_ids = sample(sampling_probs(logits, temperature, top_k, top_p), generator)
+            if eos_id is not None:
+                next_ids = next_ids.masked_fill(done, eos_id)
+                done |= next_ids == eos_id
+            out.append(next_ids.unsqueeze(1))
+            if step == max_new_tokens - 1 or (eos_id is not None and done.all()):
+                break
+            logits = model(next_ids.unsqueeze(1), None, cache=cache)[:, -1]
+        return torch.cat(out, dim=1)
+    finally:
+        model.train(was_training)
+
+
+def accept_drafts(target_probs, drafts, draft_probs=None, generator=None):
+    """
+    Speculative sampling: accept draft token i with probability
+    min(1, p_i(d) / q_i(d)) and at the first rejection sample from the
+    normalized residual max(p_i - q_i, 0) instead; if every draft is
+    accepted, one more token is sampled from the last target distribution.
+    The tokens returned are distributed exactly as sampling the target one
+    token at a time.
+
+    ``target_probs`` is (k + 1, vocab) for the k ``drafts``; ``draft_probs``
+    (k, vocab) is None for deterministic drafts, i.e. one-hot q.
+    """
+    out = []
+    for i, d in enumerate(drafts):
+        p = target_probs[i]
+        if draft_probs is None:
+            q = torch.zeros_like(p)
+            q[d] = 1.
+        else:
+            q = draft_probs[i]
+        r = torch.rand(1, generator=generator, device=p.device).item()
+        if r * q[d].item() < p[d].item():
+            out.append(d)
+            continue
+        residual = (p - q).clamp(min=0)
+        out.append(int(sample(residual / residual.sum(), generator)))
+        return out
+    out.append(int(sample(target_probs[len(drafts)], generator)))
+    return out
+
+
+def verify(model, cache, ids, drafts, draft_probs, temperature=1., top_k=0, top_p=1., generator=None):
+    """
+    Score ``drafts`` after the committed ``ids`` (a list) with one forward
+    of ``model`` and return the tokens to commit next: the accepted drafts
+    plus one token from the target. The cache is rolled back so that it
+    holds every committed id but the newest one, which the next call
+    feeds.
+    """
+    x = torch.tensor([ids[cache.length:] + drafts], device=cache_device(model))
+    h = model.decoder(x, None, cache=cache)
+    probs = sampling_probs(model.out(h[0, -(len(drafts) + 1):]), temperature, top_k, top_p)
+    new = accept_drafts(probs, drafts, draft_probs, generator)
+    cache.truncate(len(ids) + len(new) - 1)
+    return new
+
+
+def cache_device(model):
+    return next(model.parameters()).device
+
+
+class DraftModel:
+    """
+    Proposes tokens by sampling a smaller model with the same vocabulary,
+    e.g. a 2-layer, narrow starter.py Transformer trained on the same
+    token stream. Keeps its own KV cache, rolled back to the committed
+    tokens each round.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.cache = None
+
+    def start(self, max_len):
+        self.model.eval()
+        self.cache = self.model.new_cache(max_len)
+
+    def propose(self, ids, k, temperature=1., top_k=0, top_p=1., generator=None):
+        self.cache.truncate(len(ids) - 1)
+        x = torch.tensor([ids[self.cache.length:]], device=cache_device(self.model))
+        drafts, probs = [], []
+        for _ in range(k):
+            h = self.model.decoder(x, None, cache=self.cache)
+            q = sampling_probs(self.model.out(h[0, -1]), temperature, top_k, top_p)
+            d = int(q.argmax()) if temperature == 0 else int(sample(q, generator))
+            drafts.append(d)
+            probs.append(q)
+            x = x.new_tensor([[d]])
+        return drafts, torch.stack(probs)
+
+
+class PromptLookup:
+    """
+    Draft-free proposals: an index from every n-gram (n <= ``max_ngram``)
+    of the prompt and the generated ids to where it last occurred. The
+    tokens that followed the latest occurrence of the longest matching
+    suffix are proposed, which pays off whenever the continuation quotes
+    the prompt. Drafts are deterministic, so acceptance is exact with a
+    one-hot q.
+    """
+
+    def __init__(self, max_ngram=3, min_ngram=1):
+        self.max_ngram, self.min_ngram = max_ngram, min_ngram
+
+    def start(self, max_len):
+        self.index = {}
+        self.n_indexed = 1
+
+    def propose(self, ids, k, temperature=1., top_k=0, top_p=1., generator=None):
+        # index n-grams ending at every position that has a continuation
+        for end in range(self.n_indexed, len(ids)):
+            for n in range(self.min_ngram, min(self.max_ngram, end) + 1):
+                self.index[tuple(ids[end - n:end])] = end
+        self.n_indexed = max(self.n_indexed, len(ids))
+        for n in range(min(self.max_ngram, len(ids)), self.min_ngram - 1, -1):
+            end = self.index.get(tuple(ids[-n:]))
+            if end is not None:
+                return ids[end:end + k], None
+        return [], None
+
+
+@torch.no_grad()
+def speculative_generate(model, prompt, max_new_tokens, drafter, k=4, temperature=1., top_k=0, top_p=1.,
+                         eos_id=None, generator=None):
+    """
+    ``generate`` for a single sequence (prompt is (1, sl)) where each
+    target forward verifies up to ``k`` tokens proposed by ``drafter``
+    (``DraftModel`` or ``PromptLookup``) and commits between 1 and k + 1
+    of them, with the same output distribution as ``generate``. Returns
+    the sequence and a dict of counts: target forwards, proposed and
+    accepted drafts.
+    """
+    assert prompt.size(0) == 1, "speculative decoding runs one sequence at a time"
+    was_training = model.training
+    model.eval()
+    try:
+        ids = prompt[0].tolist()
+        max_len = len(ids) + max_new_tokens + k + 1
+        cache = model.new_cache(max_len)
+        drafter.start(max_len)
+        stats = {'forwards': 0, 'proposed': 0, 'accepted': 0}
+        while len(ids) - prompt.size(1) < max_new_tokens:
+            drafts, draft_probs = drafter.propose(ids, k, temperature, top_k, top_p, generator)
+            new = verify(model, cache, ids, drafts, draft_probs, temperature, top_k, top_p, generator)
+            stats['forwards'] += 1
+            stats['proposed'] += len(drafts)
+            stats['accepted'] += len(new) - 1
+            ids += new
+            if eos_id is not None and eos_id in new:
+                ids = ids[:len(ids) - len(new) + new.index(eos_id) + 1]
+                break
+        ids = ids[:prompt.size(1) + max_new_tokens]
+        return torch.tensor([ids], device=prompt.device), stats
+    finally:
+        model.train(was_training)
+
+
+def load_model(opt):
+    from starter import Transformer, set_attention_backend
+
+    model = Transformer(opt.vocab_size, opt.d_model, opt.n_layers, opt.heads, 0., tied=bool(opt.tied))
+    if opt.loadname is None:
+        print("no -loadname given, using randomly initialized weights", file=sys.stderr)
+    else:
+        model.load_state_dict(torch.load(opt.loadname, map_location='cpu'))
+    set_attention_backend(model, opt.attention)
+    return model.to(opt.device).eval()
+
+
+def load_draft_model(opt):
+    from starter import Transformer, set_attention_backend
+
+    model = Transformer(opt.vocab_size, opt.draft_d_model, opt.draft_n_layers, opt.draft_heads, 0.)
+    model.load_state_dict(torch.load(opt.draft_loadname, map_location='cpu'))
+    set_attention_backend(model, opt.attention)
+    return model.to(opt.device).eval()
+
+
+def add_sampling_args(parser):
+    parser.add_argument('-max_new_tokens', type=int, default=100)
+    parser.add_argument('-temperature', type=float, default=1.)
+    parser.add_argument('-top_k', type=int, default=0)
+    parser.add_argument('-top_p', type=float, default=1.)
+    parser.add_argument('-seed', type=int, default=10)
+
+
+def add_draft_args(parser):
+    # speculative decoding with a small draft model (see DraftModel)
+    parser.add_argument('-draft_loadname', type=str)
+    parser.add_argument('-draft_d_model', type=int, default=256)
+    parser.add_argument('-draft_n_layers', type=int, default=2)
+    parser.add_argument('-draft_heads', type=int, default=4)
+    parser.add_argument('-speculate', type=int, default=4, help="draft tokens verified per target forward")
+    parser.add_argument('-prompt_lookup', type=int, default=0,
+                        help="draft from n-grams (n <= this) of the prompt and output instead of a draft model")
+
+
+def add_model_args(parser):
+    parser.add_argument('-loadname', type=str)
+    parser.add_argument('-vocab_size', type=int, default=50257)
+    parser.add_argument('-tokenizer', type=str, default=TOKENIZER_DIR)
+    parser.add_argument('-d_model', type=int, default=512)
+    parser.add_argument('-n_layers', type=int, default=6)
+    parser.add_argument('-heads', type=int, default=8)
+    parser.add_argument('-tied', type=int, default=1)
+    parser.add_argument('-attention', type=str, default='reference')
+    parser.add_argument('-no_cuda', action='store_true')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('prompt', type=str)
+    add_model_args(parser)
+    add_sampling_args(parser)
+    add_draft_args(parser)
+    opt = parser.parse_args()
+    opt.device = torch.device('cuda:0' if torch.cuda.is_available() and not opt.no_cuda else 'cpu')
+
+    model = load_model(opt)
+    tokenizer = load_tokenizer(opt.tokenizer)
+    generator = torch.Generator(opt.device).manual_seed(opt.seed)
+    prompt = torch.tensor([tokenizer(opt.prompt)['input_ids']], device=opt.device)
+    drafter = None
+    if opt.prompt_lookup:
+        drafter = PromptLookup(opt.prompt_lookup)
+    elif opt.draft_loadname is not None:
+        drafter = DraftModel(load_draft_model(opt))
+    if drafter is not None:
+        ids, stats = speculative_generate(model, prompt, opt.max_new_tokens, drafter, opt.speculate,
+                                          opt.temperature, opt.top_k, opt.top_p, generator=generator)
+        print("accepted %d of %d drafts in %d forwards" % (stats['accepted'], stats['proposed'], stats['forwards']),
+              file=sys.stderr)
+    else:
+        ids = generate(model, prompt, opt.max_new_tokens, opt.temperature, opt.top_k, opt.top_p, generator=generator)
+    print(tokenizer.decode(ids[0].tolist()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import argparse
+import os
+
+# self-contained tokenizer artifact: vocab.json, merges.txt and the
+# serialized fast tokenizer (tokenizer.json), built once by running this file
+TOKENIZER_DIR = 'tokenizer'
+TOKENIZER_FILE = 'tokenizer.json'
+
+
+def build(out_dir=TOKENIZER_DIR, name='gpt2'):
+    # the only step that needs the hub (or its cache)
+    from transformers import GPT2TokenizerFast
+
+    tokenizer = GPT2TokenizerFast.from_pretrained(name)
+    tokenizer.save_pretrained(out_dir)
+    return out_dir
+
+
+class LocalTokenizer:
+    """
+    The subset of ``GPT2TokenizerFast`` this project uses, backed directly by
+    ``tokenizers.Tokenizer`` read from a local ``tokenizer.json``.
+
+    Nothing is read until the tokenizer is first used, and neither
+    ``transformers`` nor the network is involved. Pickling keeps only the
+    path, so pool and DataLoader workers reload the file themselves.
+    """
+
+    def __init__(self, path=TOKENIZER_DIR):
+        if os.path.isdir(path):
+            path = os.path.join(path, TOKENIZER_FILE)
+        self.path = path
+        self._backend = None
+
+    @property
+    def backend_tokenizer(self):
+        if self._backend is None:
+            from tokenizers import Tokenizer
+            self._backend = Tokenizer.from_file(self.path)
+        return self._backend
+
+    def __len__(self):
+        return self.backend_tokenizer.get_vocab_size()
+
+    def get_vocab(self):
+        return self.backend_tokenizer.get_vocab()
+
+    def __call__(self, text):
+        # GPT-2 adds no special tokens, matching GPT2TokenizerFast(text)
+        if isinstance(text, str):
+            return {'input_ids': self.backend_tokenizer.encode(text).ids}
+        return {'input_ids': [e.ids for e in self.backend_tokenizer.encode_batch(text)]}
+
+    def decode(self, ids):
+        return self.backend_tokenizer.decode(list(ids))
+
+    def __getstate__(self):
+        return {'path': self.path, '_backend': None}
+
+
+def load_tokenizer(name=TOKENIZER_DIR, fallback='gpt2'):
+    """
+    Local artifact when ``name`` points at one, otherwise
+    ``GPT2TokenizerFast.from_pretrained(name)``. A missing default artifact
+    falls back to ``fallback`` from the hub.
+    """
+    path = os.path.join(name, TOKENIZER_FILE) if os.path.isdir(name) else name
+    if os.path.isfile(path):
+        return LocalTokenizer(path)
+    if name == TOKENIZER_DIR:
+        print("no tokenizer artifact in %s (run local_tokenizer.py to build it), loading %s" % (name, fallback))
+        name = fallback
+    from transformers import GPT2TokenizerFast
+    return GPT2TokenizerFast.from_pretrained(name)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-out', type=str, default=TOKENIZER_DIR)
+    parser.add_argument('-name', type=str, default='gpt2')
+    opt = parser.parse_args()
+    print("saved %s tokenizer to %s" % (opt.name, build(opt.out, opt.name)))
+
+
+if __name__ == "__main__":
+    main()
@@ -13,10 +13,13 @@ import torch
 import torch.nn.functional as F
 import torch.nn as nn
 from torch.autograd import Variable
-from transformers import GPT2TokenizerFast
 from torch.utils.data import Dataset
 from torch.utils.data import DataLoader
 
+from local_tokenizer import TOKENIZER_DIR, load_tokenizer
+from corpus import read_corpus_cached
+from blocked_attention import blocked_attention
+
 import matplotlib.pyplot as plt
 
 
@@ -131,6 +134,25 @@ def euclidean_attention(q, k, v, mask=None, dropout=None):
     output = torch.matmul(scores, v)
     return output
 
+def euclidean_attention_expanded(q, k, v, mask=None, dropout=None):
+    # same scores as euclidean_attention via -||q - k||^2 = 2 q.k - ||k||^2 - ||q||^2,
+    # so only the (bs, N, sl, sl) score matrix is built, never the
+    # (bs, N, sl, sl, d_k) difference tensor. ||q||^2 is the same for every
+    # key of a query, so the softmax cancels it and it is left out
+    scores = 2 * torch.matmul(q, k.transpose(-2, -1)) - (k * k).sum(dim=-1).unsqueeze(-2)
+
+    if mask is not None:
+        mask = mask.unsqueeze(1)
+        scores = scores.masked_fill(mask == 0, float('-inf'))
+    
+    scores = F.softmax(scores, dim=-1)
+    
+    if dropout is not None:
+        scores = dropout(scores)
+        
+    output = torch.matmul(scores, v)
+    return output
+
 # def euclidean_attention(q, k, v, mask=None, dropout=None):
 #     scores = -torch.cdist(q, k, p=2)**2
 
@@ -162,6 +184,9 @@ class MultiHeadAttention(nn.Module):
         
         self.dropout = nn.Dropout(dropout)
         self.out = nn.Linear(d_model, d_model)
+        # 'blocked' runs the tiled blocked_attention() and treats a missing
+        # mask as causal
+        self.backend = 'reference'
     
     def forward(self, q, k, v, mask=None):
         
@@ -178,8 +203,11 @@ class MultiHeadAttention(nn.Module):
         v = v.transpose(1,2)
         
 
-        # calculate attention using function we will define next
-        scores = euclidean_attention(q, k, v, mask, self.dropout)
+        if self.backend == 'blocked':
+            scores = blocked_attention(q, k, v, 2., key_norm=1., mask=mask, is_causal=mask is None)
+        else:
+            # calculate attention using function we will define next
+            scores = euclidean_attention_expanded(q, k, v, mask, self.dropout)
         # concatenate heads and put through final linear layer
         concat = scores.transpose(1,2).contiguous()\
         .view(bs, -1, self.d_model)
@@ -405,6 +433,15 @@ class Transformer(nn.Module):
         output = self.out(d_output)
         return output
 
+ATTENTION_BACKENDS = ('reference', 'blocked')
+
+def set_attention_backend(model, backend):
+    assert backend in ATTENTION_BACKENDS
+    for m in model.modules():
+        if isinstance(m, MultiHeadAttention):
+            m.backend = backend
+    return model
+
 def get_model(opt, src_vocab, trg_vocab):
     
     assert opt.d_model % opt.heads == 0
@@ -513,6 +550,8 @@ def train_model(model, opt, train_loader, valid_loader):
         # No peak mask
         inputmask = torch.triu(torch.ones((1, 511, 511), device=opt.device), diagonal=1).bool()
         inputmask = ~inputmask
+        if opt.attention == 'blocked':
+            inputmask = None
 
         for batch in train_loader:
             inputs, targets = batch[:, :-1], batch[:, 1:]
@@ -567,6 +606,8 @@ def test_model(model, opt, epoch, test_loader):
     with torch.no_grad():  # Disable gradient computation
         inputmask = torch.triu(torch.ones((1, 511, 511), device=opt.device), diagonal=1).bool()
         inputmask = ~inputmask
+        if opt.attention == 'blocked':
+            inputmask = None
         for batch in test_loader:
             inputs, targets = batch[:,:-1], batch[:,1:]
             inputs, targets = inputs.to(opt.device), targets.to(opt.device)
@@ -626,6 +667,9 @@ def main():
     parser.add_argument('-tied', type=int, default=1)
     parser.add_argument('-dir_name', type=str,default='model')
     parser.add_argument('-norm', type=float, default=2.0)
+    parser.add_argument('-cache_dir', type=str, default='cache')
+    parser.add_argument('-tokenizer', type=str, default=TOKENIZER_DIR)
+    parser.add_argument('-attention', type=str, default='reference', choices=ATTENTION_BACKENDS)
                 
     opt = parser.parse_args()
     opt.verbose = False    
@@ -654,10 +698,10 @@ def main():
     opt.log_file = dir_name + "log_file.txt"
     
     print(str(opt))
-    tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
-    opt.train = read_corpus('wiki2.train.txt',tokenizer)
-    opt.valid = read_corpus('wiki2.valid.txt',tokenizer)
-    opt.test = read_corpus('wiki2.test.txt',tokenizer)
+    tokenizer = load_tokenizer(opt.tokenizer)
+    opt.train = read_corpus_cached('wiki2.train.txt',tokenizer,opt.cache_dir)
+    opt.valid = read_corpus_cached('wiki2.valid.txt',tokenizer,opt.cache_dir)
+    opt.test = read_corpus_cached('wiki2.test.txt',tokenizer,opt.cache_dir)
     
     #change 
     def create_fixed_length_sequences(data, sequence_length):
@@ -669,16 +713,16 @@ def main():
         return sequences
     
     print(len(opt.train))
-    train_dataset = torch.tensor(opt.train)
+    train_dataset = torch.from_numpy(opt.train.astype(np.int64))
     train_dataset = create_fixed_length_sequences(train_dataset,opt.seqlen)
     train_dataset = TextDataset(train_dataset)
     print(len(train_dataset))
     
-    valid_dataset = torch.tensor(opt.valid)
+    valid_dataset = torch.from_numpy(opt.valid.astype(np.int64))
     valid_dataset = create_fixed_length_sequences(valid_dataset,opt.seqlen)
     valid_dataset = TextDataset(valid_dataset)
     
-    test_dataset = torch.tensor(opt.test)
+    test_dataset = torch.from_numpy(opt.test.astype(np.int64))
     test_dataset = create_fixed_length_sequences(test_dataset,opt.seqlen)
     test_dataset = TextDataset(test_dataset)
     
@@ -700,6 +744,7 @@ def main():
     # opt.indices = opt.indices.to(opt.device)
     
     model = get_model(opt,opt.vocab_size,opt.vocab_size)
+    set_attention_backend(model, opt.attention)
         
     model_parameters = filter(lambda p: p.requires_grad, model.parameters())
     params = sum([np.prod(p.size()) for p in model_parameters])        
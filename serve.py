@@ -0,0 +1,409 @@
+import argparse
+import asyncio
+import collections
+import json
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from local_tokenizer import load_tokenizer
+from generate import add_model_args, add_sampling_args, load_model, sample, sampling_probs
+
+# decode slots, i.e. the largest batch run per step
+SLOTS = 8
+
+# positions per slot, prompt plus generated tokens
+SLOT_LEN = 1024
+
+
+def _is_int(x):
+    return isinstance(x, int) and not isinstance(x, bool)
+
+
+def _is_number(x):
+    return isinstance(x, (int, float)) and not isinstance(x, bool)
+
+
+class Request:
+    """
+    One generation request. Generated ids arrive on ``tokens`` (``stream``
+    iterates them) followed by None; a request that fails gets its
+    exception instead, which ``stream`` raises. The timestamps are
+    perf_counter times taken on the event loop.
+    """
+
+    def __init__(self, ids, max_new_tokens, temperature=1., top_k=0, top_p=1., eos_id=None):
+        self.ids = list(ids)
+        self.max_new_tokens = max_new_tokens
+        self.temperature, self.top_k, self.top_p = temperature, top_k, top_p
+        self.eos_id = eos_id
+        self.generated = []
+        self.error = None
+        self.tokens = asyncio.Queue()
+        self.submitted = time.perf_counter()
+        self.first_token = self.finished = None
+
+    def validate(self, vocab_size):
+        # malformed fields are rejected before they reach an engine step
+        if not all(_is_int(i) and 0 <= i < vocab_size for i in self.ids):
+            raise ValueError("ids must be integers in [0, %d)" % vocab_size)
+        if not _is_int(self.max_new_tokens) or self.max_new_tokens < 1:
+            raise ValueError("max_new_tokens must be a positive integer")
+        if not _is_number(self.temperature) or self.temperature < 0:
+            raise ValueError("temperature must be a number >= 0")
+        if not _is_int(self.top_k) or self.top_k < 0:
+            raise ValueError("top_k must be an integer >= 0")
+        if not _is_number(self.top_p) or not 0 < self.top_p <= 1:
+            raise ValueError("top_p must be a number in (0, 1]")
+        if self.eos_id is not None and not _is_int(self.eos_id):
+            raise ValueError("eos_id must be an integer")
+
+    @property
+    def done(self):
+        if self.error is not None:
+            return True
+        if len(self.generated) >= self.max_new_tokens:
+            return True
+        return self.eos_id is not None and len(self.generated) > 0 and self.generated[-1] == self.eos_id
+
+    def next_token(self, logits, generator):
+        if self.temperature == 0:
+            return int(logits.argmax())
+        return int(sample(sampling_probs(logits, self.temperature, self.top_k, self.top_p), generator))
+
+    async def stream(self):
+        while True:
+            tok = await self.tokens.get()
+            if tok is None:
+                return
+            if isinstance(tok, Exception):
+                raise tok
+            yield tok
+
+
+class Engine:
+    """
+    Continuous batching: every step admits waiting requests into free
+    slots of a SlotCache (one prefill each), runs a single decode forward
+    for all active slots, and retires the finished ones, whose slots are
+    refilled from the end so the active rows stay a prefix of the cache.
+
+    Model steps run on a worker thread so the event loop keeps accepting
+    requests and streaming tokens meanwhile. An exception in a step fails
+    only the requests it concerns; the engine keeps running.
+    """
+
+    def __init__(self, model, slots=SLOTS, slot_len=SLOT_LEN, seed=10):
+        self.model = model
+        self.cache = model.new_slot_cache(slots, slot_len)
+        self.slots, self.slot_len = slots, slot_len
+        self.device = next(model.parameters()).device
+        self.vocab_size = model.decoder.embed.embed.num_embeddings
+        self.generator = torch.Generator(self.device).manual_seed(seed)
+        self.pending = collections.deque()
+        # active[i] owns row i of the cache
+        self.active = []
+        self.wakeup = None
+        self.executor = ThreadPoolExecutor(1)
+        self.steps = 0
+
+    def submit(self, request):
+        request.validate(self.vocab_size)
+        if len(request.ids) + request.max_new_tokens > self.slot_len:
+            raise ValueError("prompt and max_new_tokens exceed the %d slot positions" % self.slot_len)
+        if not request.ids:
+            raise ValueError("empty prompt")
+        self.pending.append(request)
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return request
+
+    @torch.no_grad()
+    def step(self):
+        # runs on the worker thread; returns (request, token, finished)
+        # triples to emit, with the exception as token for failed requests
+        emitted = []
+        while self.pending and len(self.active) < self.slots:
+            req = self.pending.popleft()
+            row = len(self.active)
+            self.cache.reset(row)
+            try:
+                ids = torch.tensor([req.ids], device=self.device)
+                h = self.model.decoder(ids, None, cache=self.cache.select(row, row + 1))
+                self.cache.advance(len(req.ids))
+                tok = req.next_token(self.model.out(h[0, -1]), self.generator)
+            except Exception as e:
+                # the row is not taken, so the next request reuses it
+                self.cache.reset(row)
+                req.error = e
+                emitted.append((req, e, True))
+                continue
+            req.generated.append(tok)
+            emitted.append((req, tok, req.done))
+            self.active.append(req)
+        self.retire()
+
+        if self.active:
+            last = torch.tensor([[req.generated[-1]] for req in self.active], device=self.device)
+            try:
+                logits = self.model(last, None, cache=self.cache.select(0, len(self.active)))[:, -1]
+            except Exception as e:
+                # one forward for all rows: they all fail
+                logits = None
+                for req in self.active:
+                    req.error = e
+                    emitted.append((req, e, True))
+            if logits is not None:
+                self.cache.advance(1)
+                for req, row_logits in zip(self.active, logits):
+                    try:
+                        tok = req.next_token(row_logits, self.generator)
+                    except Exception as e:
+                        req.error = e
+                        emitted.append((req, e, True))
+                        continue
+                    req.generated.append(tok)
+                    emitted.append((req, tok, req.done))
+            self.retire()
+        self.steps += 1
+        return emitted
+
+    def retire(self):
+        for row in reversed(range(len(self.active))):
+            if self.active[row].done:
+                last = len(self.active) - 1
+                if row != last:
+                    self.cache.move(last, row)
+                    self.active[row] = self.active[last]
+                else:
+                    self.cache.reset(row)
+                self.active.pop()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        while True:
+            if not self.active and not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            try:
+                emitted = await loop.run_in_executor(self.executor, self.step)
+            except Exception as e:
+                # anything step could not pin on single requests fails the
+                # active ones and frees their slots
+                emitted = [(req, e, True) for req in self.active]
+                for row in range(len(self.active)):
+                    self.cache.reset(row)
+                self.active = []
+            for req, tok, finished in emitted:
+                now = time.perf_counter()
+                if isinstance(tok, Exception):
+                    print("request failed: %r" % tok, file=sys.stderr)
+                    req.error = tok
+                elif req.first_token is None:
+                    req.first_token = now
+                req.tokens.put_nowait(tok)
+                if finished:
+                    req.finished = now
+                    req.tokens.put_nowait(None)
+
+
+def parse_request(body, tokenizer, opt):
+    # {"prompt": text} or {"ids": [...]}, plus optional sampling settings;
+    # the fields are checked by Engine.submit
+    if not isinstance(body, dict):
+        raise ValueError("request must be a JSON object")
+    if 'ids' in body:
+        ids = body['ids']
+        if not isinstance(ids, list):
+            raise ValueError("ids must be a list of token ids")
+    else:
+        ids = tokenizer()(body['prompt'])['input_ids']
+    return Request(ids, body.get('max_new_tokens', opt.max_new_tokens),
+                   body.get('temperature', opt.temperature), body.get('top_k', opt.top_k),
+                   body.get('top_p', opt.top_p), body.get('eos_id'))
+
+
+def token_line(tok, tokenizer, **extra):
+    out = dict(extra, id=tok)
+    if tokenizer.loaded:
+        out['text'] = tokenizer().decode([tok])
+    return json.dumps(out) + '\n'
+
+
+class LazyTokenizer:
+    # prompts given as ids never need the tokenizer, so offline runs with a
+    # random model work without a tokenizer artifact
+    def __init__(self, name):
+        self.name = name
+        self.tokenizer = None
+
+    @property
+    def loaded(self):
+        return self.tokenizer is not None
+
+    def __call__(self):
+        if self.tokenizer is None:
+            self.tokenizer = load_tokenizer(self.name)
+        return self.tokenizer
+
+
+async def handle_http(engine, tokenizer, opt, reader, writer):
+    # minimal HTTP/1.1: POST /generate with a JSON body, answered with a
+    # chunked stream of one JSON line per token
+    try:
+        method, path, _ = (await reader.readline()).decode().split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode().strip()
+            if not line:
+                break
+            key, value = line.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        if method != 'POST' or path != '/generate':
+            writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+            return
+        try:
+            req = engine.submit(parse_request(json.loads(body or b'{}'), tokenizer, opt))
+        except (ValueError, KeyError, TypeError) as e:
+            msg = json.dumps({'error': str(e)}).encode()
+            writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Type: application/json\r\n'
+                         b'Content-Length: %d\r\n\r\n%s' % (len(msg), msg))
+            return
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n'
+                     b'Transfer-Encoding: chunked\r\n\r\n')
+        try:
+            async for tok in req.stream():
+                chunk = token_line(tok, tokenizer).encode()
+                writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                await writer.drain()
+        except Exception as e:
+            # the status line is already out, so the failure is the last line
+            chunk = (json.dumps({'error': str(e)}) + '\n').encode()
+            writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        writer.write(b'0\r\n\r\n')
+    finally:
+        await writer.drain()
+        writer.close()
+
+
+async def serve_stdin(engine, tokenizer, opt):
+    # one request per input line (JSON as for HTTP, or plain prompt text);
+    # tokens are written as JSON lines tagged with the input line number
+    loop = asyncio.get_running_loop()
+    streams = []
+
+    async def forward(n, req):
+        try:
+            async for tok in req.stream():
+                sys.stdout.write(token_line(tok, tokenizer, request=n))
+                sys.stdout.flush()
+        except Exception as e:
+            sys.stdout.write(json.dumps({'request': n, 'error': str(e)}) + '\n')
+            sys.stdout.flush()
+
+    for n in range(sys.maxsize):
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        if not line:
+            break
+        line = line.rstrip('\n')
+        try:
+            body = json.loads(line) if line.startswith('{') else {'prompt': line}
+            req = engine.submit(parse_request(body, tokenizer, opt))
+        except (ValueError, KeyError, TypeError) as e:
+            sys.stdout.write(json.dumps({'request': n, 'error': str(e)}) + '\n')
+            continue
+        streams.append(asyncio.ensure_future(forward(n, req)))
+    await asyncio.gather(*streams)
+
+
+async def synthetic_load(engine, n_requests, rate, prompt_lens, new_tokens, vocab_size, seed=10):
+    """
+    Submit ``n_requests`` random-id prompts with Poisson arrivals at
+    ``rate`` per second, prompt and output lengths drawn uniformly from the
+    given (lo, hi) ranges, and wait for all of them to finish.
+    """
+    rng = random.Random(seed)
+    requests = []
+
+    async def drain(req):
+        async for _ in req.stream():
+            pass
+
+    drains = []
+    for _ in range(n_requests):
+        prompt = [rng.randrange(vocab_size) for _ in range(rng.randint(*prompt_lens))]
+        req = engine.submit(Request(prompt, rng.randint(*new_tokens), temperature=0))
+        requests.append(req)
+        drains.append(asyncio.ensure_future(drain(req)))
+        await asyncio.sleep(rng.expovariate(rate))
+    await asyncio.gather(*drains)
+    return requests
+
+
+def load_report(requests):
+    latency = np.array([r.finished - r.submitted for r in requests])
+    ttft = np.array([r.first_token - r.submitted for r in requests])
+    n_tokens = sum(len(r.generated) for r in requests)
+    elapsed = max(r.finished for r in requests) - min(r.submitted for r in requests)
+    return {
+        'latency_p50': np.percentile(latency, 50),
+        'latency_p99': np.percentile(latency, 99),
+        'ttft_p50': np.percentile(ttft, 50),
+        'ttft_p99': np.percentile(ttft, 99),
+        'tokens_per_sec': n_tokens / elapsed,
+    }
+
+
+async def run_load_test(model, opt):
+    engine = Engine(model, opt.slots, opt.slot_len, opt.seed)
+    runner = asyncio.ensure_future(engine.run())
+    try:
+        requests = await synthetic_load(engine, opt.requests, opt.rate, opt.prompt_lens,
+                                        opt.new_tokens, opt.vocab_size)
+    finally:
+        runner.cancel()
+    return load_report(requests), engine.steps
+
+
+async def serve(model, opt):
+    engine = Engine(model, opt.slots, opt.slot_len, opt.seed)
+    runner = asyncio.ensure_future(engine.run())
+    tokenizer = LazyTokenizer(opt.tokenizer)
+    if opt.port is None:
+        await serve_stdin(engine, tokenizer, opt)
+        runner.cancel()
+        return
+    server = await asyncio.start_server(lambda r, w: handle_http(engine, tokenizer, opt, r, w),
+                                        opt.host, opt.port)
+    print("serving on http://%s:%d/generate" % (opt.host, opt.port), file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+
+def add_engine_args(parser):
+    parser.add_argument('-slots', type=int, default=SLOTS)
+    parser.add_argument('-slot_len', type=int, default=SLOT_LEN)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_model_args(parser)
+    add_engine_args(parser)
+    parser.add_argument('-port', type=int, help="serve HTTP on this port instead of stdin")
+    parser.add_argument('-host', type=str, default='127.0.0.1')
+    add_sampling_args(parser)
+    opt = parser.parse_args()
+    opt.device = torch.device('cuda:0' if torch.cuda.is_available() and not opt.no_cuda else 'cpu')
+
+    asyncio.run(serve(load_model(opt), opt))
+
+
+if __name__ == "__main__":
+    main()
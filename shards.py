@@ -0,0 +1,185 @@
+import argparse
+import json
+import os
+import struct
+
+import numpy as np
+
+from local_tokenizer import TOKENIZER_DIR, load_tokenizer
+from corpus import document_starts, file_digest, read_lines, tokenize_file, tokenizer_fingerprint
+
+# On-disk token store: a directory with a manifest.json and one or more
+# shard files. Each shard is
+#
+#   header   magic, format version, token itemsize, n_tokens, n_docs
+#   index    n_docs + 1 uint64 token offsets (document starts, then n_tokens)
+#   payload  n_tokens uint16 token ids
+#
+# so a reader can mmap the index and the payload in place without copying.
+# The store only grows: `python shards.py -out <store> new.txt` appends new
+# files as new shards and rewrites the manifest.
+MAGIC = b'TOKSHARD'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQQ')
+MANIFEST = 'manifest.json'
+
+# target shard size; shards only split at document boundaries
+SHARD_TOKENS = 1 << 24
+
+
+def write_shard(path, tokens, doc_starts):
+    tokens = np.ascontiguousarray(tokens, dtype=np.uint16)
+    index = np.append(np.asarray(doc_starts, dtype=np.uint64), np.uint64(len(tokens)))
+    tmp_path = path + '.tmp.%d' % os.getpid()
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, tokens.itemsize, len(tokens), len(index) - 1))
+        f.write(index.tobytes())
+        f.write(tokens.tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        magic, version, itemsize, n_tokens, n_docs = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError("%s is not a token shard" % path)
+    if version != VERSION or itemsize != 2:
+        raise ValueError("%s: unsupported shard version %d / itemsize %d" % (path, version, itemsize))
+    return n_tokens, n_docs
+
+
+class Shard:
+    """
+    Read-only view of one shard file: ``tokens`` and ``doc_starts`` are
+    memmaps straight into the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        n_tokens, n_docs = read_header(path)
+        index_offset = HEADER.size
+        payload_offset = index_offset + 8 * (n_docs + 1)
+        self.index = np.memmap(path, dtype=np.uint64, mode='r', offset=index_offset, shape=(n_docs + 1,))
+        self.tokens = np.memmap(path, dtype=np.uint16, mode='r', offset=payload_offset, shape=(n_tokens,))
+
+    @property
+    def doc_starts(self):
+        return self.index[:-1]
+
+    def __len__(self):
+        return len(self.tokens)
+
+
+def split_documents(doc_starts, n_tokens, shard_tokens):
+    # group whole documents into consecutive runs of about shard_tokens
+    bounds = [0]
+    for start in doc_starts[1:]:
+        if start - bounds[-1] >= shard_tokens:
+            bounds.append(int(start))
+    bounds.append(n_tokens)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def load_manifest(store_dir):
+    with open(os.path.join(store_dir, MANIFEST)) as f:
+        return json.load(f)
+
+
+def save_manifest(store_dir, manifest):
+    path = os.path.join(store_dir, MANIFEST)
+    tmp_path = path + '.tmp.%d' % os.getpid()
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def shard_paths(store_dir):
+    return [os.path.join(store_dir, s['file']) for s in load_manifest(store_dir)['shards']]
+
+
+def token_counts(store_dir, vocab_size):
+    # unigram histogram of the whole store, one shard in memory at a time
+    counts = np.zeros(vocab_size, dtype=np.int64)
+    for path in shard_paths(store_dir):
+        counts += np.bincount(Shard(path).tokens, minlength=vocab_size)
+    return counts
+
+
+def new_manifest(tokenizer):
+    return {
+        'version': VERSION,
+        'tokenizer': tokenizer_fingerprint(tokenizer),
+        'n_tokens': 0,
+        'shards': [],
+        'sources': [],
+    }
+
+
+def ingest(filenames, tokenizer, store_dir, shard_tokens=SHARD_TOKENS, workers=None):
+    """
+    Append raw text files to the store at ``store_dir``, creating it if
+    needed. Files whose content is already in the store are skipped, new
+    ones are tokenized into new shards, and the manifest is rewritten last
+    so readers only ever see complete shards. Existing shards are never
+    touched.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    if os.path.exists(os.path.join(store_dir, MANIFEST)):
+        manifest = load_manifest(store_dir)
+    else:
+        manifest = new_manifest(tokenizer)
+    if manifest['tokenizer'] != tokenizer_fingerprint(tokenizer):
+        raise ValueError("%s was built with a different tokenizer" % store_dir)
+
+    # stores written before appending existed record no sources, so files
+    # already in them cannot be recognised and only new ones are tracked
+    seen = set(src['sha1'] for src in manifest.setdefault('sources', []))
+    added = []
+    for filename in filenames:
+        digest = file_digest(filename)
+        if digest in seen:
+            print("%s: already in %s, skipping" % (filename, store_dir))
+            continue
+        seen.add(digest)
+        tokens, lengths = tokenize_file(filename, tokenizer, workers, with_lengths=True)
+        docs = document_starts(read_lines(filename), lengths)
+        first = len(manifest['shards'])
+        for lo, hi in split_documents(docs, len(tokens), shard_tokens):
+            name = 'shard_%05d.bin' % len(manifest['shards'])
+            shard_docs = docs[(docs >= lo) & (docs < hi)] - lo
+            write_shard(os.path.join(store_dir, name), tokens[lo:hi], shard_docs)
+            manifest['shards'].append({
+                'file': name,
+                'source': os.path.basename(filename),
+                'n_tokens': int(hi - lo),
+                'n_docs': int(len(shard_docs)),
+            })
+        manifest['sources'].append({
+            'file': os.path.basename(filename),
+            'sha1': digest,
+            'n_tokens': int(len(tokens)),
+            'shards': [first, len(manifest['shards'])],
+        })
+        manifest['n_tokens'] += int(len(tokens))
+        added.append(filename)
+    save_manifest(store_dir, manifest)
+    return manifest, added
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('-out', type=str, required=True)
+    parser.add_argument('-tokenizer', type=str, default=TOKENIZER_DIR)
+    parser.add_argument('-shard_tokens', type=int, default=SHARD_TOKENS)
+    parser.add_argument('-workers', type=int)
+    opt = parser.parse_args()
+
+    tokenizer = load_tokenizer(opt.tokenizer)
+    manifest, added = ingest(opt.files, tokenizer, opt.out, opt.shard_tokens, opt.workers)
+    print("%s: added %d files, now %d tokens in %d shards" % (
+        opt.out, len(added), manifest['n_tokens'], len(manifest['shards'])))
+
+
+if __name__ == "__main__":
+    main()
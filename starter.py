@@ -13,10 +13,19 @@ import torch
 import torch.nn.functional as F
 import torch.nn as nn
 from torch.autograd import Variable
-from transformers import GPT2TokenizerFast
 from torch.utils.data import Dataset
 from torch.utils.data import DataLoader
 
+from local_tokenizer import TOKENIZER_DIR, load_tokenizer
+from corpus import LineMemoTokenizer, read_corpus_cached, read_document_starts
+from data import (BucketBatchSampler, DocumentDataset, IGNORE_INDEX, MemmapTextDataset, PackedDocumentDataset, Prefetcher,
+                  RandomWindowSampler, ResumableSampler, ShardedTextDataset, StreamingTextDataset, causal_mask,
+                  document_mask, document_positions, pad_collate)
+from blocked_attention import blocked_attention
+from chunked_loss import chunked_cross_entropy
+from adaptive_softmax import AdaptiveSoftmaxHead
+from shards import token_counts
+
 #change 
 class TextDataset(Dataset):
     def __init__(self, data):
@@ -47,29 +56,54 @@ class Embedder(nn.Module):
     def forward(self, x):
         return self.embed(x.int())
 
+# (max_seq_len, d_model, dtype) -> (1, max_seq_len, d_model) table, shared by
+# every PositionalEncoder with the same shape
+_pe_tables = {}
+
+def positional_table(max_seq_len, d_model, dtype=None):
+    # constant 'pe' matrix with values dependant on pos and i, computed in
+    # float64 like the original math.sin/math.cos loop and then cast, so
+    # the values are unchanged
+    if dtype is None:
+        dtype = torch.get_default_dtype()
+    key = (max_seq_len, d_model, dtype)
+    if key not in _pe_tables:
+        pos = torch.arange(max_seq_len, dtype=torch.float64).unsqueeze(1)
+        i = torch.arange(0, d_model, 2, dtype=torch.float64)
+        pe = torch.zeros(max_seq_len, d_model, dtype=torch.float64)
+        pe[:, 0::2] = torch.sin(pos / (10000 ** ((2 * i)/d_model)))
+        pe[:, 1::2] = torch.cos(pos / (10000 ** ((2 * (i + 1))/d_model)))
+        _pe_tables[key] = pe.to(dtype).unsqueeze(0)
+    return _pe_tables[key]
+
 class PositionalEncoder(nn.Module):
     def __init__(self, d_model, max_seq_len = 4096, dropout = 0.1):
         super().__init__()
         self.d_model = d_model
         self.dropout = nn.Dropout(dropout)
-        # create constant 'pe' matrix with values dependant on 
-        # pos and i
-        pe = torch.zeros(max_seq_len, d_model)
-        for pos in range(max_seq_len):
-            for i in range(0, d_model, 2):
-                pe[pos, i] = \
-                math.sin(pos / (10000 ** ((2 * i)/d_model)))
-                pe[pos, i + 1] = \
-                math.cos(pos / (10000 ** ((2 * (i + 1))/d_model)))
-        pe = pe.unsqueeze(0)
-        self.register_buffer('pe', pe)
+        # the buffer is the shared cached table; .to(device) gives each
+        # module its copy, and loading never writes into it (see below)
+        self.register_buffer('pe', positional_table(max_seq_len, d_model))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 'pe' is a constant, and copying a checkpoint's values into the
+        # buffer would change the table for every model in the process.
+        # the buffer loads itself instead, which leaves it untouched
+        key = prefix + 'pe'
+        if key in state_dict and state_dict[key].shape == self.pe.shape:
+            state_dict[key] = self.pe
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
     
-    def forward(self, x):
+    def forward(self, x, positions=None):
         # make embeddings relatively larger
         x = x * math.sqrt(self.d_model)
         #add constant to embedding
         seq_len = x.size(1)
-        pe = Variable(self.pe[:,:seq_len], requires_grad=False)
+        if positions is None:
+            pe = Variable(self.pe[:,:seq_len], requires_grad=False)
+        else:
+            # per-token positions, e.g. restarting at each packed document
+            pe = self.pe[0, positions]
         if x.is_cuda:
             pe.cuda()
         x = x + pe
@@ -122,24 +156,81 @@ class MultiHeadAttention(nn.Module):
         
         self.dropout = nn.Dropout(dropout)
         self.out = nn.Linear(d_model, d_model)
+        # 'reference' runs attention() below, 'sdpa' dispatches to
+        # F.scaled_dot_product_attention and 'blocked' to the tiled
+        # blocked_attention(); see set_attention_backend
+        self.backend = 'reference'
+        self.fused_qkv = False
+
+    def fuse_qkv(self):
+        # replace q/k/v_linear by one (3 * d_model, d_model) projection so
+        # self-attention runs a single GEMM; the weights are kept as they are
+        if self.fused_qkv:
+            return self
+        self.qkv_linear = nn.Linear(self.d_model, 3 * self.d_model).to(self.q_linear.weight)
+        with torch.no_grad():
+            self.qkv_linear.weight.copy_(torch.cat([self.q_linear.weight, self.k_linear.weight, self.v_linear.weight]))
+            self.qkv_linear.bias.copy_(torch.cat([self.q_linear.bias, self.k_linear.bias, self.v_linear.bias]))
+        del self.q_linear, self.k_linear, self.v_linear
+        self.fused_qkv = True
+        return self
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints load into either layout: separate q/k/v_linear entries
+        # are concatenated for a fused module and split for an unfused one
+        names = [prefix + n + '_linear.' for n in 'qkv']
+        fused = prefix + 'qkv_linear.'
+        for p in ('weight', 'bias'):
+            if self.fused_qkv and names[0] + p in state_dict:
+                state_dict[fused + p] = torch.cat([state_dict.pop(n + p) for n in names])
+            elif not self.fused_qkv and fused + p in state_dict:
+                for n, w in zip(names, state_dict.pop(fused + p).chunk(3)):
+                    state_dict[n + p] = w
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
     
-    def forward(self, q, k, v, mask=None):
+    def forward(self, q, k, v, mask=None, is_causal=False, cache=None):
         
         bs = q.size(0)
         
         # perform linear operation and split into N heads
-        k = self.k_linear(k).view(bs, -1, self.h, self.d_k)
-        q = self.q_linear(q).view(bs, -1, self.h, self.d_k)
-        v = self.v_linear(v).view(bs, -1, self.h, self.d_k)
+        if self.fused_qkv and q is k and k is v:
+            q, k, v = self.qkv_linear(q).view(bs, -1, 3, self.h, self.d_k).unbind(2)
+        elif self.fused_qkv:
+            w, b = self.qkv_linear.weight.chunk(3), self.qkv_linear.bias.chunk(3)
+            k = F.linear(k, w[1], b[1]).view(bs, -1, self.h, self.d_k)
+            q = F.linear(q, w[0], b[0]).view(bs, -1, self.h, self.d_k)
+            v = F.linear(v, w[2], b[2]).view(bs, -1, self.h, self.d_k)
+        else:
+            k = self.k_linear(k).view(bs, -1, self.h, self.d_k)
+            q = self.q_linear(q).view(bs, -1, self.h, self.d_k)
+            v = self.v_linear(v).view(bs, -1, self.h, self.d_k)
         
         # transpose to get dimensions bs * N * sl * d_model
         k = k.transpose(1,2)
         q = q.transpose(1,2)
         v = v.transpose(1,2)
         
+        if cache is not None:
+            # attend over everything cached so far plus the new positions
+            k, v = cache.update(k, v)
+            if is_causal and mask is None:
+                mask = cache.causal_mask(q.size(2))
+                is_causal = False
 
-        # calculate attention using function we will define next
-        scores = attention(q, k, v, self.d_k, mask, self.dropout)
+        if self.backend == 'sdpa':
+            # fused kernel; a plain causal mask needs no mask tensor at all
+            if mask is not None:
+                mask = mask.unsqueeze(1)
+            dropout_p = self.dropout.p if self.training else 0.
+            scores = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=dropout_p, is_causal=is_causal and mask is None)
+        elif self.backend == 'blocked':
+            # memory linear in sl, for long contexts
+            scores = blocked_attention(q, k, v, 1 / math.sqrt(self.d_k), mask=mask, is_causal=is_causal and mask is None)
+        else:
+            if is_causal and mask is None:
+                mask = causal_mask(q.size(2), q.device)
+            # calculate attention using function we will define next
+            scores = attention(q, k, v, self.d_k, mask, self.dropout)
         # concatenate heads and put through final linear layer
         concat = scores.transpose(1,2).contiguous()\
         .view(bs, -1, self.d_model)
@@ -308,6 +399,135 @@ class Decoder(nn.Module):
             x = self.layers[i](x, e_outputs, src_mask, trg_mask)
         return self.norm(x)
 
+class KVCache:
+    """
+    Keys and values of one attention block for a batch of sequences during
+    incremental decoding, preallocated for ``max_len`` positions of which
+    the first ``length`` are filled. Lowering ``length`` with ``truncate``
+    drops the newest entries, e.g. rejected speculative tokens.
+    """
+
+    def __init__(self, max_len):
+        self.max_len = max_len
+        self.length = 0
+        self.k = self.v = None
+
+    def update(self, k, v):
+        # k, v: (bs, N, n_new, d_k); returns keys and values of all positions
+        if self.k is None:
+            shape = k.shape[:2] + (self.max_len, k.size(-1))
+            self.k = k.new_empty(shape)
+            self.v = v.new_empty(shape)
+        start, end = self.length, self.length + k.size(2)
+        assert end <= self.max_len, "cache holds %d positions" % self.max_len
+        self.k[:, :, start:end] = k
+        self.v[:, :, start:end] = v
+        self.length = end
+        return self.k[:, :, :end], self.v[:, :, :end]
+
+    def causal_mask(self, n_queries):
+        # the last n_queries positions each see everything up to themselves;
+        # a single new position sees the whole cache, so it needs no mask
+        if n_queries == 1:
+            return None
+        return torch.ones((1, n_queries, self.length), dtype=torch.bool, device=self.k.device).tril(self.length - n_queries)
+
+    def truncate(self, length):
+        self.length = min(self.length, length)
+
+class DecoderCache:
+    """A KVCache for each attention block of a DecoderOnly model."""
+
+    def __init__(self, n_layers, max_len):
+        self.layers = [(KVCache(max_len), KVCache(max_len)) for _ in range(n_layers)]
+
+    @property
+    def length(self):
+        return self.layers[0][0].length
+
+    def positions(self, n, device):
+        return torch.arange(self.length, self.length + n, device=device).unsqueeze(0)
+
+    def truncate(self, length):
+        for pair in self.layers:
+            for cache in pair:
+                cache.truncate(length)
+
+class SlotKVCache:
+    """
+    One attention block's share of a SlotCache: keys and values for every
+    slot, written at each fed row's own length.
+    """
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.k = self.v = None
+
+    def update(self, k, v):
+        c = self.slots
+        if self.k is None:
+            # rows are read up to the longest row's end. past their own
+            # end they are masked, but a 0 weight still turns a NaN value
+            # into NaN, so unwritten positions must hold finite values
+            shape = (c.n_slots, k.size(1), c.max_len, k.size(-1))
+            self.k = k.new_zeros(shape)
+            self.v = v.new_zeros(shape)
+        rows = torch.arange(c.start, c.stop, device=k.device).unsqueeze(1)
+        pos = c.positions(k.size(2), k.device)
+        assert int(pos.max()) < c.max_len, "slots hold %d positions" % c.max_len
+        # (rows, :, pos) indexing puts the indexed dims first
+        self.k[rows, :, pos] = k.transpose(1, 2)
+        self.v[rows, :, pos] = v.transpose(1, 2)
+        end = int(pos.max()) + 1
+        return self.k[c.start:c.stop, :, :end], self.v[c.start:c.stop, :, :end]
+
+    def causal_mask(self, n_queries):
+        # rows have different lengths, so even one new position needs a mask
+        # hiding the keys past its own row's end
+        pos = self.slots.positions(n_queries, self.k.device)
+        keys = torch.arange(int(pos.max()) + 1, device=pos.device)
+        return keys <= pos.unsqueeze(-1)
+
+class SlotCache:
+    """
+    Key/value caches for ``n_slots`` independent sequences of up to
+    ``max_len`` positions each, for continuous batching. ``select`` picks
+    the contiguous rows the next forward call feeds, each continuing at
+    its own ``lengths`` entry; ``advance`` then commits the fed positions.
+    ``move`` copies a row into another, so finished rows can be filled
+    from the end and the active rows stay a prefix.
+    """
+
+    def __init__(self, n_layers, n_slots, max_len):
+        self.n_slots, self.max_len = n_slots, max_len
+        self.lengths = torch.zeros(n_slots, dtype=torch.long)
+        self.start, self.stop = 0, 0
+        self.layers = [(SlotKVCache(self), SlotKVCache(self)) for _ in range(n_layers)]
+
+    def select(self, start, stop):
+        self.start, self.stop = start, stop
+        return self
+
+    def positions(self, n, device):
+        lengths = self.lengths[self.start:self.stop].to(device)
+        return lengths.unsqueeze(1) + torch.arange(n, device=device)
+
+    def advance(self, n):
+        self.lengths[self.start:self.stop] += n
+
+    def reset(self, row):
+        self.lengths[row] = 0
+
+    def move(self, src, dst):
+        n = int(self.lengths[src])
+        for pair in self.layers:
+            for cache in pair:
+                if cache.k is not None:
+                    cache.k[dst, :, :n] = cache.k[src, :, :n]
+                    cache.v[dst, :, :n] = cache.v[src, :, :n]
+        self.lengths[dst] = n
+        self.lengths[src] = 0
+
 # Decoder only, no cross attention
 # change 
 class DecoderOnlyLayer(nn.Module):
@@ -325,11 +545,16 @@ class DecoderOnlyLayer(nn.Module):
         self.attn_2 = MultiHeadAttention(heads, d_model, dropout=dropout)
         self.ff = FeedForward(d_model, dropout=dropout)
 
-    def forward(self, x, trg_mask):
+    def forward(self, x, trg_mask, cache=None):
+        # trg_mask=None means plain causal attention, which lets the sdpa
+        # backend skip building a mask. cache is this layer's pair of
+        # KVCaches, one per attention block
+        is_causal = trg_mask is None
+        cache_1, cache_2 = cache if cache is not None else (None, None)
         x2 = self.norm_1(x)
-        x = x + self.dropout_1(self.attn_1(x2, x2, x2, trg_mask))
+        x = x + self.dropout_1(self.attn_1(x2, x2, x2, trg_mask, is_causal, cache_1))
         x2 = self.norm_2(x)
-        x = x + self.dropout_2(self.attn_2(x2, x2, x2, trg_mask))
+        x = x + self.dropout_2(self.attn_2(x2, x2, x2, trg_mask, is_causal, cache_2))
         x2 = self.norm_3(x)
         x = x + self.dropout_3(self.ff(x2))
         return x 
@@ -343,27 +568,84 @@ class DecoderOnly(nn.Module):
         self.pe = PositionalEncoder(d_model, dropout=dropout)
         self.layers = get_clones(DecoderOnlyLayer(d_model, heads, dropout), N)
         self.norm = Norm(d_model)
-    def forward(self, trg, trg_mask):
+    def forward(self, trg, trg_mask, positions=None, cache=None):
+        if cache is not None and positions is None:
+            # new tokens continue after the cached ones
+            positions = cache.positions(trg.size(1), trg.device)
         x = self.embed(trg)
-        x = self.pe(x)
+        x = self.pe(x, positions)
         for i in range(self.N):
-            x = self.layers[i](x, trg_mask)
+            x = self.layers[i](x, trg_mask, None if cache is None else cache.layers[i])
         return self.norm(x)
 
 #change 
 class Transformer(nn.Module):
-    def __init__(self, trg_vocab, d_model, N, heads, dropout):
+    def __init__(self, trg_vocab, d_model, N, heads, dropout, tied=False, counts=None):
         super().__init__()
         #self.encoder = Encoder(src_vocab, d_model, N, heads, dropout)
         self.decoder = DecoderOnly(trg_vocab, d_model, N, heads, dropout)
-        self.out = nn.Linear(d_model, trg_vocab)
-    def forward(self, trg, trg_mask):
+        if counts is not None:
+            # adaptive softmax over clusters of the (trg_vocab,) token
+            # histogram; it has no single projection to tie
+            assert not tied
+            self.out = AdaptiveSoftmaxHead(d_model, counts)
+        else:
+            self.out = nn.Linear(d_model, trg_vocab)
+        self.tied = tied
+        if tied:
+            # the output projection reuses the (trg_vocab, d_model) input
+            # embedding; only its bias is separate
+            self.out.weight = self.decoder.embed.embed.weight
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        # a tied model only loads checkpoints whose output projection and
+        # embedding agree; untied ones are tied explicitly with
+        # `python convert.py tie` (see tie_checkpoint) or loaded with -tied 0
+        out, embed = prefix + 'out.weight', prefix + 'decoder.embed.embed.weight'
+        if self.tied and out in state_dict and embed in state_dict and not torch.equal(state_dict[out], state_dict[embed]):
+            error_msgs.append("%s and %s differ: the checkpoint is untied; convert it with "
+                              "`python convert.py tie` or load it with -tied 0" % (out, embed))
+            return
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+    def forward(self, trg, trg_mask, positions=None, cache=None):
         #e_outputs = self.encoder(src, src_mask)
         #print("DECODER")
         #d_output = self.decoder(trg, e_outputs, src_mask, trg_mask)
-        d_output = self.decoder(trg, trg_mask)
+        d_output = self.decoder(trg, trg_mask, positions, cache)
         output = self.out(d_output)
         return output
+    def new_cache(self, max_len):
+        return DecoderCache(self.decoder.N, max_len)
+    def new_slot_cache(self, n_slots, max_len):
+        return SlotCache(self.decoder.N, n_slots, max_len)
+
+ATTENTION_BACKENDS = ('reference', 'sdpa', 'blocked')
+
+def set_attention_backend(model, backend):
+    assert backend in ATTENTION_BACKENDS
+    for m in model.modules():
+        if isinstance(m, MultiHeadAttention):
+            m.backend = backend
+    return model
+
+def tie_checkpoint(state, keep='out'):
+    """
+    Tied version of an untied Transformer state dict: both weight entries
+    point at one tensor (so torch.save stores it once), taken from the
+    output projection or, with keep='embed', from the input embedding.
+    """
+    out, embed = 'out.weight', 'decoder.embed.embed.weight'
+    state = dict(state)
+    if keep == 'out':
+        state[embed] = state[out]
+    else:
+        state[out] = state[embed]
+    return state
+
+def fuse_qkv(model):
+    for m in model.modules():
+        if isinstance(m, MultiHeadAttention):
+            m.fuse_qkv()
+    return model
 
 def get_model(opt, src_vocab, trg_vocab):
     
@@ -371,7 +653,9 @@ def get_model(opt, src_vocab, trg_vocab):
     assert opt.dropout < 1
 
     #model = Transformer(src_vocab, trg_vocab, opt.d_model, opt.n_layers, opt.heads, opt.dropout)
-    model = Transformer(trg_vocab, opt.d_model, opt.n_layers, opt.heads, opt.dropout)
+    counts = opt.token_counts if opt.adaptive_softmax else None
+    model = Transformer(trg_vocab, opt.d_model, opt.n_layers, opt.heads, opt.dropout,
+                        tied=bool(opt.tied) and counts is None, counts=counts)
     model.to(opt.device)
        
     if opt.loadname is not None:
@@ -384,6 +668,79 @@ def get_model(opt, src_vocab, trg_vocab):
     
     return model
     
+def save_checkpoint(path, model, opt, epoch, step, totals):
+    # everything needed to continue mid-epoch: weights, optimizer and
+    # scheduler state, the data position and every RNG stream
+    state = {
+        'model': model.state_dict(),
+        'optimizer': opt.optimizer.state_dict(),
+        'sched': opt.sched.state_dict() if opt.SGDR == True else None,
+        'epoch': epoch,
+        'step': step,
+        'totals': totals,
+        'rng': {
+            'python': random.getstate(),
+            'numpy': np.random.get_state(),
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        },
+    }
+    tmp_path = path + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+def load_checkpoint(path, model, opt):
+    state = torch.load(path, map_location=opt.device, weights_only=False)
+    model.load_state_dict(state['model'])
+    opt.optimizer.load_state_dict(state['optimizer'])
+    if state['sched'] is not None:
+        opt.sched.load_state_dict(state['sched'])
+    rng = state['rng']
+    random.setstate(rng['python'])
+    np.random.set_state(rng['numpy'])
+    torch.set_rng_state(rng['torch'].cpu())
+    if rng['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in rng['cuda']])
+    return state['epoch'], state['step'], state['totals']
+
+def compute_loss(model, inputs, targets, mask, positions, opt):
+    # mean cross-entropy over the non-IGNORE_INDEX targets. with -loss_chunk
+    # the output projection and loss run that many positions at a time, so
+    # the (batch, sl, vocab) logits never exist. an adaptive softmax head
+    # computes the exact loss itself, cluster by cluster
+    if isinstance(model.out, AdaptiveSoftmaxHead):
+        h = model.decoder(inputs, mask, positions)
+        return model.out.loss(h, targets, IGNORE_INDEX)
+    if opt.loss_chunk:
+        h = model.decoder(inputs, mask, positions)
+        return chunked_cross_entropy(h.view(-1, h.size(-1)), model.out.weight, model.out.bias,
+                                     targets.view(-1), opt.loss_chunk, IGNORE_INDEX)
+    outputs = model(inputs, mask, positions)
+    return F.cross_entropy(outputs.view(-1, outputs.size(-1)), targets.view(-1))
+
+def prepare_batch(batch, opt, inputmask):
+    # split a batch into shifted inputs/targets on opt.device, plus the mask
+    # and position ids to run them with. packed-document batches come as
+    # (tokens, segments) and get a block-diagonal mask instead of inputmask
+    segments = None
+    if isinstance(batch, (list, tuple)):
+        batch, segments = batch
+    inputs, targets = batch[:,:-1], batch[:,1:]
+    # .contiguous() so targets.view(-1) also works when the copy to the
+    # device is a no-op (cpu)
+    inputs, targets = inputs.to(opt.device), targets.to(opt.device).contiguous()
+    if segments is None:
+        # bucketed batches vary in length; padding sits at the end and
+        # only needs a valid id as input (its targets are ignored), even
+        # when a full-length piece sets the batch length. a None inputmask
+        # leaves the causal mask to the model
+        inputs = inputs.clamp(min=0)
+        if inputmask is not None and inputs.size(1) != inputmask.size(-1):
+            inputmask = causal_mask(inputs.size(1), inputs.device)
+        return inputs, targets, inputmask, None
+    segments = segments[:,:-1].to(opt.device)
+    return inputs, targets, document_mask(segments), document_positions(segments)
+
 def train_model(model, opt, train_loader,valid_loader):
     # write code to:
     #  1. create a nopeak mask
@@ -399,23 +756,44 @@ def train_model(model, opt, train_loader,valid_loader):
     print("training model...")
     model.train()
 
+    start_epoch, start_step, totals = 0, 0, (0, 0)
+    if opt.checkpoint is not None and opt.resume and os.path.exists(opt.checkpoint):
+        start_epoch, start_step, totals = load_checkpoint(opt.checkpoint, model, opt)
+        print("resuming from epoch %d step %d" % (start_epoch, start_step))
+    sampler = getattr(opt, 'train_sampler', None)
+    if start_step > 0 and sampler is None:
+        # -random_windows, -bucket_tokens and -stream loaders cannot skip
+        # the batches already trained on, so the epoch would be replayed
+        raise ValueError("%s stops mid-epoch (step %d), but only the default shuffled loader can resume there"
+                         % (opt.checkpoint, start_step))
+
     #train loop
-    for epoch in range(opt.epochs):
+    for epoch in range(start_epoch, opt.epochs):
         print("epoch %d" % (epoch))
         total_train_loss = 0
         total_train_tokens = 0
+        step = 0
+        if epoch == start_epoch and start_step > 0:
+            # pick up mid-epoch without replaying the batches already seen
+            step = start_step
+            total_train_loss, total_train_tokens = totals
+        if sampler is not None:
+            sampler.set_epoch(epoch, step * opt.batchsize)
+        model.train()
         #print(len(train_loader))
         inputmask = torch.triu(torch.ones((1, 511, 511), device=opt.device), diagonal=1).bool()
         inputmask = ~inputmask
+        if opt.attention != 'reference':
+            # these backends apply causality without a mask tensor
+            inputmask = None
         for batch in train_loader:
             # print(batch)
             # Your training logic here
-            inputs, targets = batch[:,:-1], batch[:,1:]  # Input is the current token, target is the next token
-            inputs, targets = inputs.to(opt.device), targets.to(opt.device)  # Ensure data is on the correct device
+            # Input is the current token, target is the next token, on the correct device
+            inputs, targets, mask, positions = prepare_batch(batch, opt, inputmask)
 
             # Forward pass
-            outputs = model(inputs, inputmask)
-            loss = F.cross_entropy(outputs.view(-1, outputs.size(-1)), targets.view(-1))
+            loss = compute_loss(model, inputs, targets, mask, positions, opt)
 
             # Backward and optimize
             opt.optimizer.zero_grad()
@@ -425,13 +803,20 @@ def train_model(model, opt, train_loader,valid_loader):
             if opt.SGDR == True:
                 opt.sched.step()
 
-            total_train_loss += loss.item() * targets.numel()
-            total_train_tokens += targets.numel()
+            n_targets = (targets != IGNORE_INDEX).sum().item()
+            total_train_loss += loss.item() * n_targets
+            total_train_tokens += n_targets
             #total_train_loss += loss.item() * inputs.size(0)
             #total_train_tokens += inputs.size(0)
 
+            step += 1
+            if opt.checkpoint is not None and opt.checkpoint_every > 0 and step % opt.checkpoint_every == 0:
+                save_checkpoint(opt.checkpoint, model, opt, epoch, step, (total_train_loss, total_train_tokens))
+
         train_perplexity = torch.exp(torch.tensor(total_train_loss / total_train_tokens))
         print(f"Train perplexity: {train_perplexity}")
+        if isinstance(train_loader, Prefetcher):
+            print(train_loader.stats())
             
         model.eval()  # Set the model to evaluation mode
         total_val_loss = 0
@@ -439,21 +824,23 @@ def train_model(model, opt, train_loader,valid_loader):
 
         with torch.no_grad():  # Disable gradient computation
             for batch in valid_loader:
-                inputs, targets = batch[:,:-1], batch[:,1:]
-                inputs, targets = inputs.to(opt.device), targets.to(opt.device)
+                inputs, targets, mask, positions = prepare_batch(batch, opt, inputmask)
 
                 # Forward pass
                 # inputmask = torch.triu(torch.ones((1, inputs.size(1), inputs.size(1)), device=opt.device), diagonal=1).bool()
-                outputs = model(inputs, inputmask)
-                loss = F.cross_entropy(outputs.view(-1, outputs.size(-1)), targets.view(-1))
+                loss = compute_loss(model, inputs, targets, mask, positions, opt)
 
-                total_val_loss += loss.item() * targets.numel()
-                total_val_tokens += targets.numel()
+                n_targets = (targets != IGNORE_INDEX).sum().item()
+                total_val_loss += loss.item() * n_targets
+                total_val_tokens += n_targets
                 #total_val_loss += loss.item() * inputs.size(0)
                 #total_val_tokens += inputs.size(0)
                 
             val_perplexity = torch.exp(torch.tensor(total_val_loss / total_val_tokens))
             print(f"Validation perplexity: {val_perplexity}")
+
+        if opt.checkpoint is not None:
+            save_checkpoint(opt.checkpoint, model, opt, epoch + 1, 0, (0, 0))
     
     
 def test_model(model, opt, epoch, test_loader):
@@ -464,17 +851,19 @@ def test_model(model, opt, epoch, test_loader):
     with torch.no_grad():  # Disable gradient computation
         inputmask = torch.triu(torch.ones((1, 511, 511), device=opt.device), diagonal=1).bool()
         inputmask = ~inputmask
+        if opt.attention != 'reference':
+            # these backends apply causality without a mask tensor
+            inputmask = None
         for batch in test_loader:
-            inputs, targets = batch[:,:-1], batch[:,1:]
-            inputs, targets = inputs.to(opt.device), targets.to(opt.device)
+            inputs, targets, mask, positions = prepare_batch(batch, opt, inputmask)
 
             # Forward pass
             #inputmask = torch.triu(torch.ones((1, inputs.size(1), inputs.size(1)), device=opt.device), diagonal=1).bool()
-            outputs = model(inputs, inputmask)
-            loss = F.cross_entropy(outputs.view(-1, outputs.size(-1)), targets.view(-1))
+            loss = compute_loss(model, inputs, targets, mask, positions, opt)
             
-            total_test_loss += loss.item() * targets.numel()
-            total_test_tokens += targets.numel()
+            n_targets = (targets != IGNORE_INDEX).sum().item()
+            total_test_loss += loss.item() * n_targets
+            total_test_tokens += n_targets
             #total_test_loss += loss.item() * inputs.size(0)
             #total_test_tokens += inputs.size(0)
             
@@ -487,6 +876,83 @@ def collate_fn(batch):
     batch = torch.tensor(batch).unsqueeze(1)  # 增加一个序列长度维度
     return batch
 
+#change 
+def create_fixed_length_sequences(data, sequence_length):
+    # Split the data into chunks of `sequence_length`, discarding the remainder
+    num_full_batches = len(data) // sequence_length
+    # Slice the data to ensure it's a multiple of `sequence_length`
+    truncated_length = num_full_batches * sequence_length
+    sequences = data[:truncated_length].view(-1, sequence_length)
+    return sequences
+
+def build_loaders(opt, tokenizer):
+    splits = ['wiki2.train.txt', 'wiki2.valid.txt', 'wiki2.test.txt']
+    batch_size = opt.batchsize
+
+    if opt.stream:
+        # tokenization runs inside the loaders, block by block
+        datasets = [StreamingTextDataset(name, tokenizer, opt.seqlen) for name in splits]
+        return [DataLoader(d, batch_size=batch_size, drop_last=True, num_workers=opt.num_workers) for d in datasets]
+
+    if opt.shard_dir is not None:
+        # one store per split, built with `python shards.py -out <shard_dir>/train ...`
+        datasets = [ShardedTextDataset(os.path.join(opt.shard_dir, split), opt.seqlen) for split in ['train', 'valid', 'test']]
+    else:
+        opt.train = read_corpus_cached(splits[0],tokenizer,opt.cache_dir)
+        opt.valid = read_corpus_cached(splits[1],tokenizer,opt.cache_dir)
+        opt.test = read_corpus_cached(splits[2],tokenizer,opt.cache_dir)
+        print(len(opt.train))
+
+        if opt.bucket_tokens is not None:
+            # whole documents of up to seqlen tokens, batched by length under a token budget
+            loaders = []
+            for data in [opt.train, opt.valid, opt.test]:
+                dataset = DocumentDataset(data.filename, read_document_starts(data.filename), opt.seqlen)
+                sampler = BucketBatchSampler(dataset.lengths, opt.bucket_tokens, opt.bucket_width, seed=opt.seed)
+                loaders.append(DataLoader(dataset, batch_sampler=sampler, collate_fn=pad_collate, num_workers=opt.num_workers))
+            return loaders
+
+        datasets = []
+        for data in [opt.train, opt.valid, opt.test]:
+            if opt.doc_packing:
+                # windows carry document ids so attention resets between articles
+                dataset = PackedDocumentDataset(data.filename, read_document_starts(data.filename), opt.seqlen)
+            elif opt.mmap:
+                # windows are sliced straight out of the cached token files
+                dataset = MemmapTextDataset(data.filename, opt.seqlen)
+            else:
+                dataset = torch.from_numpy(data.astype(np.int64))
+                dataset = create_fixed_length_sequences(dataset,opt.seqlen)
+                dataset = TextDataset(dataset)
+            datasets.append(dataset)
+    print(len(datasets[0]))
+
+    loaders = [DataLoader(d, batch_size=batch_size, shuffle=True, drop_last=True, num_workers=opt.num_workers) for d in datasets]
+    if opt.random_windows:
+        # training windows start anywhere in the token store, re-drawn each epoch
+        if opt.doc_packing:
+            train_dataset = PackedDocumentDataset(opt.train.filename, read_document_starts(opt.train.filename), opt.seqlen, stride=1)
+        else:
+            train_dataset = MemmapTextDataset(opt.train.filename, opt.seqlen, stride=1)
+        sampler = RandomWindowSampler(train_dataset, opt.epoch_tokens, seed=opt.seed)
+        loaders[0] = DataLoader(train_dataset, batch_size=batch_size, sampler=sampler, drop_last=True, num_workers=opt.num_workers)
+    elif opt.checkpoint is not None:
+        # a (seed, epoch) order that train_model can fast-forward on resume.
+        # the loader gets its own generator so starting an epoch does not
+        # draw from the global torch RNG that the checkpoint restores
+        opt.train_sampler = ResumableSampler(len(datasets[0]), opt.seed)
+        loaders[0] = DataLoader(datasets[0], batch_size=batch_size, sampler=opt.train_sampler, drop_last=True, num_workers=opt.num_workers,
+                                generator=torch.Generator().manual_seed(opt.seed))
+    return loaders
+
+def train_token_counts(opt, tokenizer):
+    # unigram histogram of the training split, which sets the adaptive
+    # softmax clusters
+    if opt.shard_dir is not None:
+        return token_counts(os.path.join(opt.shard_dir, 'train'), opt.vocab_size)
+    train = read_corpus_cached('wiki2.train.txt', tokenizer, opt.cache_dir)
+    return np.bincount(train, minlength=opt.vocab_size)
+
 def main():
     
     random.seed(10)
@@ -509,8 +975,33 @@ def main():
     parser.add_argument('-tied', type=int, default=1)
     parser.add_argument('-dir_name', type=str,default='model')
     parser.add_argument('-norm', type=float, default=2.0)
+    parser.add_argument('-cache_dir', type=str, default='cache')
+    parser.add_argument('-tokenizer', type=str, default=TOKENIZER_DIR)
+    parser.add_argument('-mmap', action='store_true')
+    parser.add_argument('-stream', action='store_true')
+    parser.add_argument('-random_windows', action='store_true')
+    parser.add_argument('-epoch_tokens', type=int)
+    parser.add_argument('-doc_packing', action='store_true')
+    parser.add_argument('-shard_dir', type=str)
+    parser.add_argument('-num_workers', type=int, default=0)
+    parser.add_argument('-bucket_tokens', type=int)
+    parser.add_argument('-bucket_width', type=int, default=64)
+    parser.add_argument('-line_memo', type=int, default=0)
+    parser.add_argument('-prefetch', type=int, default=0)
+    parser.add_argument('-seed', type=int, default=10)
+    parser.add_argument('-checkpoint', type=str)
+    parser.add_argument('-checkpoint_every', type=int, default=500)
+    parser.add_argument('-resume', action='store_true')
+    parser.add_argument('-attention', type=str, default='reference', choices=ATTENTION_BACKENDS)
+    parser.add_argument('-fused_qkv', action='store_true')
+    parser.add_argument('-loss_chunk', type=int, default=0)
+    parser.add_argument('-adaptive_softmax', action='store_true')
                 
     opt = parser.parse_args()
+    if opt.SGDR and opt.stream:
+        # the cosine cycle spans one epoch, and streamed epochs have no
+        # length known up front
+        parser.error("-SGDR needs the number of batches per epoch, which -stream loaders do not have")
     opt.verbose = False    
     
     opt.device = 0 if opt.no_cuda is False else -1
@@ -530,46 +1021,16 @@ def main():
     opt.log_file = dir_name + "log_file.txt"
     
     print(str(opt))
-    tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
-    opt.train = read_corpus('wiki2.train.txt',tokenizer)
-    opt.valid = read_corpus('wiki2.valid.txt',tokenizer)
-    opt.test = read_corpus('wiki2.test.txt',tokenizer)
-    
-    
-    
-    #change 
-    def create_fixed_length_sequences(data, sequence_length):
-        # Split the data into chunks of `sequence_length`, discarding the remainder
-        num_full_batches = len(data) // sequence_length
-        # Slice the data to ensure it's a multiple of `sequence_length`
-        truncated_length = num_full_batches * sequence_length
-        sequences = data[:truncated_length].view(-1, sequence_length)
-        return sequences
-    
-    print(len(opt.train))
-    train_dataset = torch.tensor(opt.train)
-    train_dataset = create_fixed_length_sequences(train_dataset,opt.seqlen)
-    train_dataset = TextDataset(train_dataset)
-    print(len(train_dataset))
-    
-    valid_dataset = torch.tensor(opt.valid)
-    valid_dataset = create_fixed_length_sequences(valid_dataset,opt.seqlen)
-    valid_dataset = TextDataset(valid_dataset)
-    
-    test_dataset = torch.tensor(opt.test)
-    test_dataset = create_fixed_length_sequences(test_dataset,opt.seqlen)
-    test_dataset = TextDataset(test_dataset)
-    
-
-    batch_size = opt.batchsize
-    #train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, drop_last=True, collate_fn=collate_fn)
-    #valid_loader = DataLoader(valid_dataset, batch_size=batch_size, shuffle=True, drop_last=True, collate_fn=collate_fn)
-    #test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=True, drop_last=True, collate_fn=collate_fn)
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, drop_last=True)
-    valid_loader = DataLoader(valid_dataset, batch_size=batch_size, shuffle=True, drop_last=True)
-    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=True, drop_last=True)
+    tokenizer = load_tokenizer(opt.tokenizer)
+    if opt.line_memo > 0:
+        tokenizer = LineMemoTokenizer(tokenizer, opt.line_memo)
+    train_loader, valid_loader, test_loader = build_loaders(opt, tokenizer)
+    if opt.line_memo > 0:
+        print(tokenizer.stats())
+    if opt.prefetch > 0:
+        # prepare the next batches and their device copies while the model runs
+        train_loader, valid_loader, test_loader = [Prefetcher(l, opt.device, opt.prefetch) for l in [train_loader, valid_loader, test_loader]]
     
-    obs = len(opt.train)
     opt.vocab_size = 50257
     temp = []
     for i in range(opt.vocab_size):
@@ -577,7 +1038,14 @@ def main():
     opt.indices = torch.tensor(temp)
     opt.indices = opt.indices.cuda()
     
+    if opt.adaptive_softmax:
+        opt.token_counts = train_token_counts(opt, tokenizer)
+        if opt.tied:
+            print("-adaptive_softmax: output head is not tied to the embedding")
     model = get_model(opt,opt.vocab_size,opt.vocab_size)
+    set_attention_backend(model, opt.attention)
+    if opt.fused_qkv:
+        fuse_qkv(model)
         
     model_parameters = filter(lambda p: p.requires_grad, model.parameters())
     params = sum([np.prod(p.size()) for p in model_parameters])        
@@ -586,6 +1054,8 @@ def main():
 
     opt.optimizer = torch.optim.Adam(model.parameters(), lr=opt.lr, betas=(0.9, 0.98), eps=1e-9)
     if opt.SGDR == True:
+        # one cosine cycle per epoch
+        opt.train_len = len(train_loader)
         opt.sched = CosineWithRestarts(opt.optimizer, T_max=opt.train_len)
 
     if opt.savename is not None:
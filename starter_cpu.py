@@ -13,9 +13,11 @@ import torch
 import torch.nn.functional as F
 import torch.nn as nn
 from torch.autograd import Variable
-from transformers import GPT2TokenizerFast
 from torch.utils.data import Dataset
 from torch.utils.data import DataLoader
+
+from local_tokenizer import TOKENIZER_DIR, load_tokenizer
+from corpus import read_corpus_cached
 from torch.nn.utils.rnn import pad_sequence
 
 #change 
@@ -505,6 +507,8 @@ def main():
     parser.add_argument('-tied', type=int, default=1)
     parser.add_argument('-dir_name', type=str,default='model')
     parser.add_argument('-norm', type=float, default=2.0)
+    parser.add_argument('-cache_dir', type=str, default='cache')
+    parser.add_argument('-tokenizer', type=str, default=TOKENIZER_DIR)
                 
     opt = parser.parse_args()
     opt.verbose = False    
@@ -527,10 +531,10 @@ def main():
     
     print(str(opt))
     
-    tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
-    opt.train = read_corpus('wiki2.train.txt',tokenizer)
-    opt.valid = read_corpus('wiki2.valid.txt',tokenizer)
-    opt.test = read_corpus('wiki2.test.txt',tokenizer)
+    tokenizer = load_tokenizer(opt.tokenizer)
+    opt.train = read_corpus_cached('wiki2.train.txt',tokenizer,opt.cache_dir)
+    opt.valid = read_corpus_cached('wiki2.valid.txt',tokenizer,opt.cache_dir)
+    opt.test = read_corpus_cached('wiki2.test.txt',tokenizer,opt.cache_dir)
     
     #change 
     train_dataset = TextDataset(opt.train)